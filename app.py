@@ -1,11 +1,38 @@
 import os
+import io
 import datetime
+import contextlib
+import itertools
+import hashlib
+import gzip
+import threading
+import time
 from flask import Flask, request, render_template, redirect, url_for, session
 import json
+from leaderboard import Leaderboard
+from write_behind import WriteBehind
+from render_cache import RenderCache
+from static_assets import StaticAssets, Documents, send_asset
+from level_format import (LevelFormatError, compact_level_text, expand_level_text, read_campaign,
+                          check_level, split_sections, chunk_key)
 
 # Initialize Flask app
-app = Flask(__name__, static_folder='.', static_url_path='')
-app.secret_key = os.urandom(24)  # For session management
+# Static files are served from memory by static_file() below, only from
+# the directories the pages use
+app = Flask(__name__, static_folder=None)
+# Sessions must verify in every worker process, so deployments running more
+# than one set SLASHA_SECRET_KEY; a single process can make up its own key
+app.secret_key = os.environ.get('SLASHA_SECRET_KEY') or os.urandom(24)  # For session management
+
+# Send level terrain to the browser in the compact encoding, and optionally
+# store it that way too (exports always carry the JSON grid)
+app.config['COMPACT_TERRAIN'] = os.environ.get('SLASHA_COMPACT_TERRAIN', '1') != '0'
+app.config['COMPACT_STORAGE'] = os.environ.get('SLASHA_COMPACT_STORAGE', '0') != '0'
+
+# Memory given to rendered level pages, see render_cache.py
+app.config['RENDER_CACHE_MB'] = int(os.environ.get('SLASHA_RENDER_CACHE_MB', '32'))
+# and to campaign exports
+app.config['PACKAGE_CACHE_MB'] = int(os.environ.get('SLASHA_PACKAGE_CACHE_MB', '16'))
 
 # Mock NDB models for local development
 class Model:
@@ -15,9 +42,7 @@ class Model:
         self.key = None
     
     def put(self):
-        # In a real app, this would save to the database
-        # For now, we'll just print for debugging
-        print(f"Saving {self.__class__.__name__}: {self.__dict__}")
+        # Models without storage of their own have nothing to save
         return self
 
 class StringProperty:
@@ -36,51 +61,433 @@ class DateTimeProperty:
     def __init__(self, auto_now=False):
         self.auto_now = auto_now
 
+# Hash-indexed table: rows are kept in insertion order and every index maps a
+# tuple of attribute values to the rows carrying them, so lookups on indexed
+# fields cost O(1) (or O(k) for k matches) instead of a scan over the table.
+# Each table has its own lock, so threads working on different tables never
+# wait on each other.
+class Table:
+    def __init__(self, unique=None, indexes=()):
+        self.unique = unique
+        self.indexes = {fields: {} for fields in ((unique,) if unique else ()) + tuple(indexes)}
+        self.rows = {}
+        self.row_keys = {}
+        self.lock = threading.RLock()
+    
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self.rows.values()))
+    
+    def __len__(self):
+        return len(self.rows)
+    
+    def _key(self, item, fields):
+        try:
+            return tuple(getattr(item, f) for f in fields)
+        except AttributeError:
+            return None
+    
+    def get(self, **filters):
+        rows = self.lookup(filters)
+        return rows[0] if rows else None
+    
+    def lookup(self, filters):
+        # Use the index covering the most filter fields, then check the rest
+        best = None
+        for fields in self.indexes:
+            if all(f in filters for f in fields) and (best is None or len(fields) > len(best)):
+                best = fields
+        rest = {k: v for k, v in filters.items() if best is None or k not in best}
+        with self.lock:
+            if best is None:
+                candidates = self.rows.values()
+            else:
+                candidates = self.indexes[best].get(tuple(filters[f] for f in best), {}).values()
+            return [item for item in candidates if MemoryDB._match_filters(item, rest)]
+    
+    def insert(self, item):
+        with self.lock:
+            # Re-saving a row that was edited in place must reindex it
+            self.remove(item)
+            if self.unique:
+                existing = self.indexes[self.unique].get(self._key(item, self.unique))
+                for old in list(existing.values()) if existing else []:
+                    self.remove(old)
+            rowid = id(item)
+            self.rows[rowid] = item
+            keys = {}
+            for fields, index in self.indexes.items():
+                key = self._key(item, fields)
+                if key is not None:
+                    index.setdefault(key, {})[rowid] = item
+                    keys[fields] = key
+            self.row_keys[rowid] = keys
+            return item
+    
+    def remove(self, item):
+        rowid = id(item)
+        with self.lock:
+            if rowid not in self.rows:
+                return False
+            del self.rows[rowid]
+            for fields, key in self.row_keys.pop(rowid).items():
+                bucket = self.indexes[fields][key]
+                del bucket[rowid]
+                if not bucket:
+                    del self.indexes[fields][key]
+            return True
+
+# Level text kept once per distinct section (see split_sections()), with a
+# count of the stored levels using each piece
+class ChunkStore:
+    def __init__(self):
+        self.chunks = {}
+        self.lock = threading.Lock()
+    
+    def add(self, text):
+        keys = []
+        with self.lock:
+            for piece in split_sections(text):
+                key = chunk_key(piece)
+                entry = self.chunks.get(key)
+                if entry is None:
+                    self.chunks[key] = [piece, 1]
+                else:
+                    entry[1] += 1
+                keys.append(key)
+        return tuple(keys)
+    
+    def release(self, keys):
+        with self.lock:
+            for key in keys:
+                entry = self.chunks[key]
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self.chunks[key]
+    
+    def text(self, keys):
+        # None when the keys were released meanwhile
+        with self.lock:
+            try:
+                return ''.join([self.chunks[key][0] for key in keys])
+            except KeyError:
+                return None
+    
+    def stats(self):
+        with self.lock:
+            entries = list(self.chunks.values())
+        return {'chunks': len(entries), 'bytes': sum(len(piece) for piece, _ in entries),
+                'refs': sum(refs for _, refs in entries)}
+
+# Levels of every campaign kept as an ordered sequence where a level's
+# counter is its position, so inserting, deleting or moving a level is one
+# list operation on that entry instead of re-saving every later level.
+# Counters are stamped onto the rows as they are read back. Every campaign
+# has its own lock, so requests on different campaigns run side by side.
+# While stored, a level's text lives in the chunk store; levels taken out
+# get their own copy back.
+class LevelSequences:
+    def __init__(self):
+        self.sequences = {}
+        self.members = {}
+        self.locks = {}
+        self.chunks = ChunkStore()
+        # Every change to a campaign's levels gives it a new version and
+        # refreshes its catalog entry
+        self.versions = {}
+        self.clock = itertools.count(1)
+        self.catalog = {}
+        self.catalog_lock = threading.Lock()
+    
+    def __iter__(self):
+        return iter(self.lookup({}))
+    
+    def __len__(self):
+        return len(self.members)
+    
+    def lock(self, campaign):
+        lock = self.locks.get(campaign)
+        if lock is None:
+            lock = self.locks.setdefault(campaign, threading.RLock())
+        return lock
+    
+    def rows(self, campaign):
+        rows = []
+        with self.lock(campaign):
+            for n, level in enumerate(self.sequences.get(campaign, ()), 1):
+                if level is not None:
+                    level.counter = n
+                    rows.append(level)
+        return rows
+    
+    def lookup(self, filters):
+        if 'campaign' not in filters:
+            candidates = [level for campaign in list(self.sequences) for level in self.rows(campaign)]
+        elif 'counter' in filters:
+            with self.lock(filters['campaign']):
+                sequence = self.sequences.get(filters['campaign'], [])
+                n = filters['counter']
+                level = sequence[n - 1] if isinstance(n, int) and 0 < n <= len(sequence) else None
+                if level is None:
+                    return []
+                level.counter = n
+            candidates = [level]
+        else:
+            candidates = self.rows(filters['campaign'])
+        indexed = ('campaign', 'counter') if 'campaign' in filters else ()
+        rest = {k: v for k, v in filters.items() if k not in indexed}
+        return [level for level in candidates if MemoryDB._match_filters(level, rest)]
+    
+    def _position(self, level):
+        sequence = self.sequences[self.members[id(level)]]
+        n = getattr(level, 'counter', 0)
+        if isinstance(n, int) and 0 < n <= len(sequence) and sequence[n - 1] is level:
+            return sequence, n - 1
+        return sequence, sequence.index(level)
+    
+    def _place(self, level, replace):
+        # Called with the campaign's lock held. Levels go into an existing
+        # slot or right after the last one, never further out.
+        sequence = self.sequences.get(level.campaign, [])
+        i = level.counter - 1 if isinstance(level.counter, int) else -1
+        if not 0 <= i <= len(sequence):
+            raise ValueError(f"level {level.counter} is outside campaign '{level.campaign}'")
+        self.sequences[level.campaign] = sequence
+        if i == len(sequence):
+            sequence.append(None)
+        elif not replace:
+            sequence.insert(i, None)
+        if sequence[i] is not None:
+            del self.members[id(sequence[i])]
+            self._detach(sequence[i])
+        sequence[i] = level
+        self.members[id(level)] = level.campaign
+        self._attach(level)
+        self._touch(level.campaign)
+        return level
+    
+    def _attach(self, level):
+        level.stored_chunks = (self.chunks, self.chunks.add(level.text or ''))
+        level._text = None
+    
+    def _detach(self, level):
+        chunks, keys = level.stored_chunks
+        if level._text is None:
+            level._text = chunks.text(keys)
+        level.stored_chunks = None
+        chunks.release(keys)
+    
+    def _trim(self, campaign):
+        sequence = self.sequences[campaign]
+        while sequence and sequence[-1] is None:
+            sequence.pop()
+        if not sequence:
+            del self.sequences[campaign]
+        self._touch(campaign)
+    
+    def _touch(self, campaign):
+        self.versions[campaign] = next(self.clock)
+        sequence = self.sequences.get(campaign)
+        if not sequence:
+            with self.catalog_lock:
+                self.catalog.pop(campaign, None)
+            return
+        first = next(level for level in sequence if level is not None)
+        entry = {
+            'campaign': campaign,
+            'levels': len(sequence),
+            'owner': first.owner,
+            'nick': first.nick,
+            'modified': datetime.datetime.now(),
+        }
+        with self.catalog_lock:
+            self.catalog[campaign] = entry
+    
+    def catalog_snapshot(self):
+        # Entries are replaced whole, never changed, so a shallow copy is
+        # safe to iterate while other threads keep writing
+        with self.catalog_lock:
+            return dict(self.catalog)
+    
+    def insert(self, level):
+        # Upsert into the slot at level.counter
+        self.remove(level)
+        with self.lock(level.campaign):
+            return self._place(level, replace=True)
+    
+    def remove(self, level):
+        # Empty the level's slot without moving later levels
+        campaign = self.members.get(id(level))
+        if campaign is None:
+            return False
+        with self.lock(campaign):
+            if self.members.get(id(level)) != campaign:
+                return False
+            sequence, i = self._position(level)
+            sequence[i] = None
+            del self.members[id(level)]
+            self._detach(level)
+            self._trim(campaign)
+            return True
+    
+    def insert_at(self, level):
+        # Insert at level.counter, moving the later levels up by one
+        self.remove(level)
+        with self.lock(level.campaign):
+            return self._place(level, replace=False)
+    
+    def pop(self, campaign, counter):
+        # Remove the level at counter, moving the later levels down by one
+        with self.lock(campaign):
+            sequence = self.sequences.get(campaign, [])
+            if not 0 < counter <= len(sequence):
+                return None
+            level = sequence.pop(counter - 1)
+            if level is not None:
+                del self.members[id(level)]
+                self._detach(level)
+            self._trim(campaign)
+            return level
+    
+    def move(self, campaign, old, new):
+        with self.lock(campaign):
+            level = self.pop(campaign, old)
+            if level is not None:
+                level.counter = new
+                self._place(level, replace=False)
+            return level
+
 # Create a simple in-memory database
 class MemoryDB:
+    # Only this process writes to it
+    shared = False
+    
     def __init__(self):
-        self.savedata = []
-        self.results = []
-        self.levels = []
+        self.savedata = Table(unique=('player', 'campaign'), indexes=[('player',), ('campaign',)])
+        self.results = Table(indexes=[('campaign', 'counter', 'win')])
+        self.levels = LevelSequences()
+        self.seeds = {}
+    
+    def table(self, model_class):
+        return {
+            'Savedata': self.savedata,
+            'Result': self.results,
+            'Level': self.levels,
+        }.get(model_class.__name__)
     
     def query(self, model_class, **filters):
-        if model_class.__name__ == 'Savedata':
-            return [item for item in self.savedata if self._match_filters(item, filters)]
-        elif model_class.__name__ == 'Result':
-            return [item for item in self.results if self._match_filters(item, filters)]
-        elif model_class.__name__ == 'Level':
-            return [item for item in self.levels if self._match_filters(item, filters)]
-        return []
+        table = self.table(model_class)
+        if table is None:
+            return []
+        return table.lookup(filters)
     
-    def _match_filters(self, item, filters):
+    @staticmethod
+    def _match_filters(item, filters):
         for key, value in filters.items():
             if not hasattr(item, key) or getattr(item, key) != value:
                 return False
         return True
     
     def save(self, item):
-        if item.__class__.__name__ == 'Savedata':
-            # Remove existing items with same player and campaign
-            self.savedata = [s for s in self.savedata if not (s.player == item.player and s.campaign == item.campaign)]
-            self.savedata.append(item)
-        elif item.__class__.__name__ == 'Result':
-            self.results.append(item)
-        elif item.__class__.__name__ == 'Level':
-            # Remove existing level with same campaign and counter
-            self.levels = [l for l in self.levels if not (l.campaign == item.campaign and l.counter == item.counter)]
-            self.levels.append(item)
+        # Savedata and Level upsert on their unique key, Results always append
+        table = self.table(item.__class__)
+        if table is not None:
+            table.insert(item)
         return item
     
     def delete(self, item):
-        if item.__class__.__name__ == 'Savedata':
-            self.savedata.remove(item)
-        elif item.__class__.__name__ == 'Result':
-            self.results.remove(item)
-        elif item.__class__.__name__ == 'Level':
-            self.levels.remove(item)
+        table = self.table(item.__class__)
+        if table is not None:
+            table.remove(item)
+    
+    def campaign_version(self, campaign):
+        return self.levels.versions.get(campaign, 0)
+    
+    def catalog(self):
+        # Name, level count, owner and last change of every campaign
+        return self.levels.catalog_snapshot()
+    
+    def progress(self, player):
+        # The player's save point in each campaign they have played
+        return {save.campaign: save.counter for save in self.savedata.lookup({'player': player})}
+    
+    def insert_level(self, level):
+        return self.levels.insert_at(level)
+    
+    def delete_level(self, campaign, counter):
+        return self.levels.pop(campaign, counter)
+    
+    def move_level(self, campaign, old, new):
+        return self.levels.move(campaign, old, new)
+    
+    def results_since(self, key):
+        # Results are fed to the leaderboard as they are stored, see Result.put
+        return []
+    
+    def seed_state(self, path):
+        return self.seeds.get(path)
+    
+    def record_seed(self, path, entry):
+        self.seeds[path] = entry
+    
+    def shift_saves(self, campaign, start, delta, player=None):
+        # Move every save point at or after start by delta in one pass,
+        # dropping the ones that fall off the front of the campaign
+        filters = {'campaign': campaign}
+        if player is not None:
+            filters['player'] = player
+        with self.savedata.lock:
+            for save in self.savedata.lookup(filters):
+                if save.counter >= start:
+                    save.counter += delta
+                    if save.counter <= 0:
+                        self.savedata.remove(save)
+    
+    def save_progress(self, save):
+        # Store the save point unless the player already got further in
+        # the campaign, as one atomic step
+        with self.savedata.lock:
+            existing = self.savedata.get(player=save.player, campaign=save.campaign)
+            if existing is not None and existing.counter >= save.counter:
+                return existing
+            return self.savedata.insert(save)
+    
+    @contextlib.contextmanager
+    def transaction(self):
+        # Writes to memory are applied as they happen; the context groups
+        # them the same way the persistent backends commit a batch once
+        yield self
+    
+    def put_multi(self, items):
+        with self.transaction():
+            return [self.save(item) for item in items]
+    
+    def chunk_stats(self):
+        # Distinct pieces of level text stored, their size and their users
+        return self.levels.chunks.stats()
+
+# Pick the storage backend: SLASHA_DB=sqlite:///path/to/file.db keeps the
+# data in SQLite, anything else uses the in-memory database
+def create_db(url):
+    if url.startswith('sqlite:///'):
+        from sqlite_db import SQLiteDB
+        return SQLiteDB(url[len('sqlite:///'):])
+    return MemoryDB()
 
 # Create global database instance
-db = MemoryDB()
+db = create_db(os.environ.get('SLASHA_DB', 'memory'))
+
+# High scores per level, updated as results are stored
+leaderboard = Leaderboard()
+
+# Campaigns bundled in data/ are imported at startup under this account
+BUNDLED_USER = {'user_id': 'bundled', 'nickname': 'Slasha'}
+DATA_DIR = 'data'
+
+# Store several entities as one batch, like ndb.put_multi
+def put_multi(entities):
+    with db.transaction():
+        return [entity.put() for entity in entities]
 
 # Context manager for database operations (dummy for compatibility)
 class ndb_context:
@@ -123,25 +530,87 @@ class Result(Model):
     worldtime = DateTimeProperty(auto_now=True)
     
     def put(self):
-        self.worldtime = datetime.datetime.now()
-        return db.save(self)
+        if not isinstance(self.worldtime, datetime.datetime):
+            self.worldtime = datetime.datetime.now()
+        db.save(self)
+        # A shared database is read back by every worker, see Leaderboard.catch_up
+        if not db.shared:
+            leaderboard.record(self)
+        return self
 
 class Level(Model):
-    text = TextProperty()
     counter = IntegerProperty()
     campaign = StringProperty()
     owner = StringProperty()
     nick = StringProperty()
     date = DateTimeProperty(auto_now=True)
     
+    # The text is held by the level, or, while it is stored in memory, by
+    # the store's ChunkStore as (store, chunk keys), see LevelSequences
+    _text = None
+    stored_chunks = None
+    
+    @property
+    def text(self):
+        stored = self.stored_chunks
+        if self._text is None and stored is not None:
+            text = stored[0].text(stored[1])
+            if text is not None:
+                return text
+        # The level was taken out of the store while being read; taking it
+        # out gives it its own copy before the chunks are released
+        return self._text
+    
+    @text.setter
+    def text(self, value):
+        self._text = value
+    
     def put(self):
         self.date = datetime.datetime.now()
+        self.compact()
         return db.save(self)
     
+    def insert(self):
+        # Store at self.counter, moving the later levels of the campaign up
+        self.date = datetime.datetime.now()
+        self.compact()
+        return db.insert_level(self)
+    
+    def compact(self):
+        # Levels are stored with the terrain in the compact encoding unless
+        # that is switched off
+        if app.config['COMPACT_STORAGE']:
+            self.text = compact_level_text(self.text)
+    
+    def page_text(self):
+        # Level text as embedded in a page, with the terrain in the compact
+        # encoding unless that is switched off; kept until the text changes
+        cached = getattr(self, '_page_text', None)
+        source = self._text if self._text is not None else self.stored_chunks
+        if cached is None or cached[0] is not source:
+            if app.config['COMPACT_TERRAIN']:
+                cached = (source, compact_level_text(self.text))
+            else:
+                cached = (source, expand_level_text(self.text))
+            self._page_text = cached
+        return cached[1]
+    
     @staticmethod
     def query():
         return LevelQuery()
 
+if hasattr(db, 'register'):
+    db.register(Savedata, Result, Level)
+    leaderboard.catch_up(db)
+
+# Level pages as last rendered, see game() and editor()
+render_cache = RenderCache(app.config['RENDER_CACHE_MB'] * 1024 * 1024,
+                           sizeof=lambda page: len(page['body']) + len(page['gzip']))
+
+# Game results are statistics only, so they are stored in batches in the
+# background and the next level renders without waiting for them
+result_writer = WriteBehind(put_multi, max_pending=1000, batch_size=100, name='result-writer')
+
 class LevelQuery:
     def filter(self, *args, **kwargs):
         self.filters = kwargs
@@ -188,36 +657,79 @@ def main_page():
         </div></center>
         '''
 
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+static_assets = StaticAssets(APP_DIR, ('javascript', 'images'))
+documents = Documents(APP_DIR)
+app.jinja_env.globals['asset_url'] = static_assets.url
+
+@app.route('/<any(javascript, images):folder>/<path:name>', methods=['GET'])
+def static_file(folder, name):
+    asset = static_assets.get(f'{folder}/{name}')
+    if asset is None:
+        return "Not found", 404
+    return send_asset(app, request, asset)
+
 @app.route('/devguide', methods=['GET', 'POST'])
 def devguide():
-    with open('devguide.html', 'r') as file:
-        return file.read()
+    doc = documents.get('devguide.html')
+    if doc is None:
+        return "Development guide not found", 404
+    return send_asset(app, request, doc)
 
 @app.route('/example', methods=['GET', 'POST'])
 def example():
-    with open('tutorial.txt', 'r') as file:
-        return file.read(), 200, {'Content-Type': 'text/plain'}
+    doc = documents.get('tutorial.txt')
+    if doc is None:
+        return "Tutorial file not found", 404
+    return send_asset(app, request, doc)
+
+# Levels of an imported campaign stored per put_multi() call
+LOAD_BATCH = 100
 
 def load_campaign(pkg, user):
-    lines = pkg.replace("\r","").split("\n")
-    name = lines[0][lines[0].find(": ") + 2:]
-    n = 1
-    breaks = []
-    while n < len(lines):
-        if "--------" in lines[n]: 
-            breaks.append(n)
-        n += 1
-    breaks.append(len(lines))
-    
-    for b in range(len(breaks) - 1):
-        level = Level(
-            text='\n'.join(lines[breaks[b] + 1:breaks[b + 1]]),
-            campaign=name,
-            counter=b + 1,
-            owner=user['user_id'],
-            nick=user['nickname']
-        )
-        level.put()
+    # pkg is the package text or a text stream of it
+    if isinstance(pkg, str):
+        pkg = io.StringIO(pkg)
+    name, texts = read_campaign(pkg)
+    store_campaign(name, texts, user)
+
+def decoded_lines(stream):
+    # Lines of an uploaded file as text, decoded one at a time
+    for number, line in enumerate(stream, 1):
+        try:
+            yield line.decode('utf-8')
+        except UnicodeDecodeError:
+            raise LevelFormatError(f"line {number} is not UTF-8 text")
+
+def store_campaign(name, texts, user):
+    # Store levels as they are read, a batch at a time, in one transaction.
+    # Every level is checked on the way; a broken one stops the import and
+    # takes the levels this import stored back out. Memory has no rollback,
+    # so they are deleted one by one; other backends roll them back anyway.
+    with db.transaction():
+        stored = []
+        try:
+            levels = []
+            for counter, text in enumerate(texts, 1):
+                problems = check_level(text)
+                if problems:
+                    raise LevelFormatError(f"level {counter}: {'; '.join(problems)}")
+                levels.append(Level(
+                    text=text,
+                    campaign=name,
+                    counter=counter,
+                    owner=user['user_id'],
+                    nick=user['nickname']
+                ))
+                if len(levels) == LOAD_BATCH:
+                    put_multi(levels)
+                    stored.extend(levels)
+                    levels = []
+            put_multi(levels)
+        except LevelFormatError:
+            for level in reversed(stored):
+                db.delete(level)
+            raise
 
 def create_level(text, campaign, counter, owner, nick):
     level = Level(
@@ -229,24 +741,101 @@ def create_level(text, campaign, counter, owner, nick):
     )
     return level
 
-def package_campaign(campaign):
-    level_entities = db.query(Level, campaign=campaign, counter=1)
+def build_package(campaign):
+    # Levels from counter 1 up to the first gap, fetched in one ordered query
+    levels = []
+    for level in db.query(Level, campaign=campaign):
+        if level.counter != len(levels) + 1:
+            break
+        levels.append(level)
     
-    if not level_entities:
+    if not levels:
         return ""
-        
-    s = "Name: " + campaign + "\n"
-    s += "Created by: " + level_entities[0].nick + "\n"
-    s += "Date: " + str(level_entities[0].date) + "\n"
-    
-    n = 1
-    while level_entities:
-        s += "-----------------------\n"
-        s += level_entities[0].text + "\n"
-        n += 1
-        level_entities = db.query(Level, campaign=campaign, counter=n)
-        
-    return s
+    
+    parts = [
+        "Name: " + campaign,
+        "Created by: " + levels[0].nick,
+        "Date: " + str(levels[0].date),
+    ]
+    for level in levels:
+        parts.append("-----------------------")
+        parts.append(expand_level_text(level.text))
+    return "\n".join(parts) + "\n"
+
+# Campaign exports by campaign version, so level saves, shifts and deletes
+# make a new key and the old export ages out. The gzip variant is made on
+# first request, after the size is taken, so the text counts twice to leave
+# room for it.
+package_cache = RenderCache(app.config['PACKAGE_CACHE_MB'] * 1024 * 1024,
+                            sizeof=lambda export: 2 * len(export['text']))
+
+def package_export(campaign):
+    def build():
+        text = build_package(campaign)
+        return {
+            'text': text,
+            'etag': hashlib.sha1(text.encode('utf-8')).hexdigest(),
+            'gzip': None,
+        }
+    return package_cache.render((campaign, db.campaign_version(campaign)), build)
+
+def package_campaign(campaign):
+    return package_export(campaign)['text']
+
+# Response for a body with a precomputed ETag, honouring If-None-Match and
+# sending the gzip variant to clients that accept it
+def send_cached(body, etag, mimetype, gzipped=None, cache_control='no-cache'):
+    if gzipped is not None and 'gzip' in request.accept_encodings:
+        response = app.response_class(gzipped, mimetype=mimetype)
+        response.headers['Content-Encoding'] = 'gzip'
+        response.set_etag(etag + '-gzip')
+    else:
+        response = app.response_class(body, mimetype=mimetype)
+        response.set_etag(etag)
+    response.headers['Cache-Control'] = cache_control
+    response.vary.add('Accept-Encoding')
+    return response.make_conditional(request)
+
+# Level page from the render cache, rendered and compressed on a miss
+def send_page(key, render):
+    def build():
+        body = render().encode('utf-8')
+        return {
+            'body': body,
+            'etag': hashlib.sha1(body).hexdigest(),
+            'gzip': gzip.compress(body, 6),
+        }
+    page = render_cache.render(key, build)
+    return send_cached(page['body'], page['etag'], 'text/html',
+                       gzipped=page['gzip'], cache_control='private, no-cache')
+
+@app.route('/package/<path:campaign>', methods=['GET'])
+def campaign_package(campaign):
+    user = get_current_user()
+    if not user:
+        return redirect(url_for('main_page'))
+    
+    # Same rule as the inlined package: only the owner gets the export
+    first_level = db.query(Level, campaign=campaign, counter=1)
+    if not first_level or first_level[0].owner != user['user_id']:
+        return "Campaign not found", 404
+    
+    export = package_export(campaign)
+    if export['gzip'] is None:
+        export['gzip'] = gzip.compress(export['text'].encode('utf-8'))
+    return send_cached(export['text'].encode('utf-8'), export['etag'], 'text/plain',
+                       gzipped=export['gzip'], cache_control='private, no-cache')
+
+def js_string(text):
+    # A JavaScript string literal that is also safe inside a <script> tag
+    return json.dumps(text).replace('<', '\\u003c')
+
+def import_failed(error):
+    return render_template('template.html',
+                          init_vars=f"alert({js_string(f'Campaign not imported: {error}')});",
+                          js_file="javascript/startscreen.js",
+                          level_data="",
+                          campaign_data="")
 
 @app.route('/startscreen', methods=['GET', 'POST'])
 def startscreen():
@@ -256,30 +845,35 @@ def startscreen():
     if not user:
         return redirect(url_for('main_page'))
     
-    # Process uploaded campaigns from data directory
-    if os.path.exists('data'):
-        for d in os.listdir('data'):
-            with open(os.path.join('data', d), 'r') as file:
-                textcmp = file.read()
-                name = textcmp[textcmp.find(": ") + 2:textcmp.find("\n")]
-                
-                # Check if campaign exists
-                campaign_levels = db.query(Level, campaign=name)
-                campaign_exists = len(campaign_levels) > 0
-                
-                if not campaign_exists:
-                    load_campaign(textcmp, user)
+    # Upload campaign file if provided. It is read straight from the upload,
+    # which large files keep on disk, one level at a time.
+    upload = request.files.get('campaign_file')
+    if upload is not None and upload.filename:
+        try:
+            name, texts = read_campaign(decoded_lines(upload.stream))
+            if db.query(Level, campaign=name):
+                return render_template('template.html', 
+                                      init_vars="alert('Campaign already exists!');",
+                                      js_file="javascript/startscreen.js",
+                                      level_data="",
+                                      campaign_data="")
+            store_campaign(name, texts, user)
+        except LevelFormatError as e:
+            return import_failed(e)
     
     # Upload campaign from textbox if provided
     textcmp = request.form.get('campaign', '')
     if "---------" in textcmp:
-        name = textcmp[textcmp.find(": ") + 2:textcmp.find("\n")-1]
+        name, texts = read_campaign(io.StringIO(textcmp))
         
         campaign_levels = db.query(Level, campaign=name)
         campaign_exists = len(campaign_levels) > 0
         
         if not campaign_exists:
-            load_campaign(textcmp, user)
+            try:
+                store_campaign(name, texts, user)
+            except LevelFormatError as e:
+                return import_failed(e)
         else:
             return render_template('template.html', 
                                   init_vars="alert('Campaign already exists!');",
@@ -293,44 +887,29 @@ def startscreen():
     
     # Load save data
     saves = []
-    campaigns = {}
-    campaign_status = {}
+    catalog = db.catalog()
+    progress = db.progress(user['user_id'])
     
-    # Get all levels
-    all_levels = db.levels
-    for level in all_levels:
-        if not hasattr(level, 'campaign'):
-            continue
-        if level.campaign not in campaigns:
-            campaigns[level.campaign] = 0
-        if campaigns[level.campaign] < level.counter:
-            campaigns[level.campaign] = level.counter
-    
-    # Get existing saves for the current user
-    existing_saves = db.query(Savedata, player=user['user_id'])
-    for save in existing_saves:
-        if not hasattr(save, 'campaign'):
-            continue
-        save_campaign = [s.get('campaign') for s in saves if 'campaign' in s]
-        if save.campaign not in save_campaign and save.campaign in campaigns:
-            campaign_status[save.campaign] = save.counter
+    # Campaigns the user has saves for come first
+    for campaign, counter in progress.items():
+        if campaign in catalog:
             saves.append({
-                'player': save.player,
-                'nick': save.nick,
-                'campaign': save.campaign,
-                'counter': save.counter,
-                'levels': campaigns[save.campaign]
+                'player': user['user_id'],
+                'nick': user['nickname'],
+                'campaign': campaign,
+                'counter': counter,
+                'levels': catalog[campaign]['levels']
             })
     
     # Add campaigns not in saves
-    for c in campaigns.keys():
-        if c not in campaign_status:
+    for campaign, info in catalog.items():
+        if campaign not in progress:
             saves.append({
                 'player': user['user_id'],
                 'nick': user['nickname'],
-                'campaign': c,
+                'campaign': campaign,
                 'counter': 1,
-                'levels': campaigns[c]
+                'levels': info['levels']
             })
     
     # Prepare JavaScript init variables
@@ -346,7 +925,13 @@ def startscreen():
                           init_vars=init_vars,
                           js_file="javascript/startscreen.js",
                           level_data="",
-                          campaign_data="")
+                          campaign_data="",
+                          upload=True)
+
+def new_slot(levels, counter):
+    # A level can only be added right after the last one of its campaign,
+    # so campaigns never get gaps
+    return counter == max((level.counter for level in levels), default=0) + 1
 
 @app.route('/play', methods=['POST'])
 def game():
@@ -361,27 +946,17 @@ def game():
     
     campaign = infoarray[0]
     counter = int(infoarray[1])
+    if counter < 1:
+        return redirect(url_for('startscreen'))
     
-    rminloss = [99999, "null"]
-    rmaxratio = [0, "null"]
-    rmintime = [99999, "null"]
-    rminrt = [99999, "null"]
-    
-    # Handle save game state
-    # Delete inferior saves
-    existing_saves = db.query(Savedata, player=user['user_id'], campaign=campaign)
-    for save in existing_saves:
-        if save.counter < counter:
-            db.delete(Savedata, save)
-    
-    # Create a new save
+    # Handle save game state: keep the furthest save point
     save = Savedata(
         player=user['user_id'],
         nick=user['nickname'],
         campaign=campaign,
         counter=counter
     )
-    save.put()
+    db.save_progress(save)
     
     # Record score if provided
     if len(scorearray) >= 5:
@@ -394,9 +969,10 @@ def game():
             friendly_losses=int(scorearray[1]),
             enemy_losses=int(scorearray[2]),
             time=int(scorearray[3]),
-            realtime=int(scorearray[4])
+            realtime=int(scorearray[4]),
+            worldtime=datetime.datetime.now()
         )
-        score.put()
+        result_writer.submit(score)
     
     message = request.form.get('message', '')
     
@@ -411,92 +987,52 @@ def game():
             # Check if adding to existing campaign
             same_campaign = db.query(Level, campaign=campaign)
             
-            if same_campaign and same_campaign[0].owner == user['user_id']:
+            if not new_slot(same_campaign, counter):
+                wecanedit = 0  # Levels are only added after the last one
+            elif same_campaign and same_campaign[0].owner == user['user_id']:
                 wecanedit = 1  # Adding to a campaign
             elif not same_campaign:
                 wecanedit = 1  # Creating a new campaign
     
     # Handle level editing if allowed
+    rejected = None
     if wecanedit == 1:
         if len(infoarray) > 2 and infoarray[2] == 'save':
-            data = request.form.get('data', '').replace('\r', '')
+            data = expand_level_text(request.form.get('data', '').replace('\r', ''))
             
-            # Delete existing level
-            current_levels = db.query(Level, campaign=campaign, counter=counter)
-            for level in current_levels:
-                db.delete(Level, level)
-            
-            # Create and save the updated level
-            level = Level(
-                text=data,
-                campaign=campaign,
-                counter=counter,
-                owner=user['user_id'],
-                nick=user['nickname']
-            )
-            level.put()
+            # Save the updated level, replacing the existing one in one step,
+            # unless it would not work in the game
+            problems = check_level(data)
+            if problems:
+                rejected = 'Level not saved: ' + '; '.join(problems)
+            else:
+                level = Level(
+                    text=data,
+                    campaign=campaign,
+                    counter=counter,
+                    owner=user['user_id'],
+                    nick=user['nickname']
+                )
+                level.put()
         
         elif len(infoarray) > 2 and infoarray[2] == 'delete':
-            # Delete the current level
-            current_levels = db.query(Level, campaign=campaign, counter=counter)
-            for level in current_levels:
-                db.delete(Level, level)
-            
-            # Shift later levels back by one
-            later_levels = db.query(Level, campaign=campaign)
-            later_levels = [level for level in later_levels if level.counter > counter]
-            
-            for level in later_levels:
-                level_data = {
-                    'text': level.text,
-                    'campaign': level.campaign,
-                    'counter': level.counter - 1,
-                    'owner': level.owner,
-                    'nick': level.nick
-                }
-                db.delete(Level, level)
-                
-                new_level = Level(**level_data)
-                new_level.put()
+            # Delete the current level, shifting later levels back by one
+            db.delete_level(campaign, counter)
             
             # Adjust player progress
             if counter > 1:
                 counter -= 1
             
             # Update savepoints
-            existing_saves = db.query(Savedata, player=user['user_id'], campaign=campaign)
-            for save in existing_saves:
-                save_counter = save.counter
-                db.delete(Savedata, save)
-                
-                if save_counter > counter:
-                    save_counter -= 1
-                
-                if save_counter > 0:
-                    new_save = Savedata(
-                        player=save.player,
-                        nick=save.nick,
-                        campaign=save.campaign,
-                        counter=save_counter
-                    )
-                    new_save.put()
+            db.shift_saves(campaign, counter + 1, -1, player=user['user_id'])
     
     # Get high scores for the level
-    results = db.query(Result, campaign=campaign, counter=counter, win=1)
+    if db.shared:
+        leaderboard.catch_up(db)
     
-    for result in results:
-        if result.friendly_losses < rminloss[0]:
-            rminloss = [result.friendly_losses, result.nick]
-        
-        ratio = result.enemy_losses / (result.friendly_losses + 0.01)
-        if ratio > rmaxratio[0]:
-            rmaxratio = [ratio, result.nick]
-        
-        if result.time < rmintime[0]:
-            rmintime = [result.time, result.nick]
-        
-        if result.realtime * 0.001 < rminrt[0]:
-            rminrt = [result.realtime * 0.001, result.nick]
+    # Versions are read before the level, so a save landing in between
+    # leaves the page under a key that is already stale
+    version = (db.campaign_version(campaign), leaderboard.version(campaign, counter))
     
     # Get level data
     current_level = db.query(Level, campaign=campaign, counter=counter)
@@ -504,32 +1040,49 @@ def game():
     if not current_level:
         return redirect(url_for('startscreen'))
     
+    owner = current_level[0].owner == user['user_id']
+    # If we lost, go straight to time = 0
+    start_time = -1 if len(scorearray) < 5 or scorearray[0] == "1" else 0
+    
+    if rejected:
+        # The stored level with the reason, not worth caching
+        return render_game(current_level[0], owner, start_time, notice=rejected)
+    
+    # The page only depends on the level, its records and who is looking
+    key = ('play', campaign, counter) + version + (owner, start_time)
+    return send_page(key, lambda: render_game(current_level[0], owner, start_time))
+
+def render_game(level, owner, start_time, notice=None):
+    campaign = level.campaign
+    counter = level.counter
+    records = leaderboard.best(campaign, counter)
+    rminloss = records['minloss']
+    rmaxratio = records['maxratio']
+    rmintime = records['mintime']
+    rminrt = records['minrt']
+    
     # Prepare JavaScript initialization variables
     init_vars = f'minloss = [{rminloss[0]}, \'{rminloss[1]}\'];\n'
     init_vars += f'maxratio = [{rmaxratio[0]}, \'{rmaxratio[1]}\'];\n'
     init_vars += f'mintime = [{rmintime[0]}, \'{rmintime[1]}\'];\n'
     init_vars += f'minrt = [{rminrt[0]}, \'{rminrt[1]}\'];\n'
-    
-    # If we lost, go straight to time = 0
-    if len(scorearray) < 5 or scorearray[0] == "1":
-        init_vars += "start_time = -1;\n"
-    else:
-        init_vars += "start_time = 0;\n"
-    
+    init_vars += f"start_time = {start_time};\n"
     init_vars += f"campaign = '{campaign}';\ncounter = {counter};\n"
     
     # Set edit status
-    if current_level[0].owner == user['user_id']:
+    if owner:
         init_vars += "edit_status = 'CAN';"
     else:
         init_vars += "edit_status = 'CANNOT';"
+    if notice:
+        init_vars += f"\nalert({js_string(notice)});"
     
     # Package campaign data for owner
     campaign_data = ""
-    if user['user_id'] == current_level[0].owner:
+    if owner:
         campaign_data = package_campaign(campaign)
     
-    level_data = current_level[0].text
+    level_data = level.page_text()
     
     return render_template('template.html',
                           init_vars=init_vars,
@@ -551,6 +1104,8 @@ def editor():
     
     campaign = messagearray[0]
     counter = int(messagearray[1])
+    if counter < 1:
+        return redirect(url_for('startscreen'))
     
     # Check if user can edit the level
     current_levels = db.query(Level, campaign=campaign, counter=counter)
@@ -562,7 +1117,9 @@ def editor():
         # Check if adding to existing campaign
         same_campaign = db.query(Level, campaign=campaign)
         
-        if same_campaign and same_campaign[0].owner == user['user_id']:
+        if not new_slot(same_campaign, counter):
+            wecanedit = 0  # Levels are only added after the last one
+        elif same_campaign and same_campaign[0].owner == user['user_id']:
             wecanedit = 1  # Adding to a campaign
         elif not same_campaign:
             wecanedit = 1  # Creating a new campaign
@@ -575,41 +1132,10 @@ def editor():
         except:
             default_data = "No default level template found."
         
-        # Shift all levels after this one
-        later_levels = db.query(Level, campaign=campaign)
-        later_levels = [level for level in later_levels if level.counter >= counter]
-        
-        for level in later_levels:
-            level_data = {
-                'text': level.text,
-                'campaign': level.campaign,
-                'counter': level.counter + 1,
-                'owner': level.owner,
-                'nick': level.nick
-            }
-            db.delete(Level, level)
-            
-            new_level = Level(**level_data)
-            new_level.put()
-        
         # Update savepoints
-        existing_saves = db.query(Savedata, player=user['user_id'], campaign=campaign)
-        for save in existing_saves:
-            save_counter = save.counter
-            db.delete(Savedata, save)
-            
-            if save_counter >= counter:
-                save_counter += 1
-            
-            new_save = Savedata(
-                player=save.player,
-                nick=save.nick,
-                campaign=save.campaign,
-                counter=save_counter
-            )
-            new_save.put()
+        db.shift_saves(campaign, counter, 1, player=user['user_id'])
         
-        # Create the new level
+        # Create the new level, shifting all levels after it
         if counter == 1:
             # Creating a new campaign with default level
             level = Level(
@@ -619,7 +1145,7 @@ def editor():
                 owner=user['user_id'],
                 nick=user['nickname']
             )
-            level.put()
+            level.insert()
         else:
             # Copy classes from previous level
             prev_levels = db.query(Level, campaign=campaign, counter=(counter - 1))
@@ -633,7 +1159,10 @@ def editor():
                     owner=user['user_id'],
                     nick=user['nickname']
                 )
-                level.put()
+                level.insert()
+    
+    # Read before the level, see game()
+    version = db.campaign_version(campaign)
     
     # Get level data for editing
     current_level = db.query(Level, campaign=campaign, counter=counter)
@@ -641,15 +1170,23 @@ def editor():
     if not current_level:
         return redirect(url_for('startscreen'))
     
+    owner = current_level[0].owner == user['user_id']
+    key = ('edit', campaign, counter, version, owner)
+    return send_page(key, lambda: render_editor(current_level[0], owner))
+
+def render_editor(level, owner):
+    campaign = level.campaign
+    counter = level.counter
+    
     # Prepare JavaScript initialization variables
     init_vars = f"var campaign = '{campaign}';\nvar counter = {counter};\n"
     init_vars += "var edit_status = 2;"
     
-    level_data = current_level[0].text
+    level_data = level.page_text()
     
     # Package campaign data for owner
     campaign_data = ""
-    if user['user_id'] == current_level[0].owner:
+    if owner:
         campaign_data = package_campaign(campaign)
     
     return render_template('template.html',
@@ -658,6 +1195,71 @@ def editor():
                           level_data=level_data,
                           campaign_data=campaign_data)
 
+# The database records every bundled campaign file as last imported: the
+# mtime and size it was read at, so unchanged files are not even re-read,
+# and its content hash, so touched but identical files are not re-imported
+def seed_campaigns(user=BUNDLED_USER):
+    if not os.path.isdir(DATA_DIR):
+        return
+    for d in os.listdir(DATA_DIR):
+        path = os.path.join(DATA_DIR, d)
+        stat = os.stat(path)
+        stamp = f"{stat.st_mtime_ns}:{stat.st_size}"
+        entry = db.seed_state(path)
+        if entry and entry['stamp'] == stamp:
+            continue
+        
+        with open(path, 'r') as file:
+            textcmp = file.read()
+        digest = hashlib.sha1(textcmp.encode('utf-8')).hexdigest()
+        if entry and entry['hash'] == digest:
+            db.record_seed(path, dict(entry, stamp=stamp))
+            continue
+        
+        name, texts = read_campaign(io.StringIO(textcmp))
+        campaign_levels = db.query(Level, campaign=name)
+        try:
+            # Check the whole file before touching the levels it replaces;
+            # the memory backend cannot roll a failed import back
+            texts = list(texts)
+            for counter, text in enumerate(texts, 1):
+                problems = check_level(text)
+                if problems:
+                    raise LevelFormatError(f"level {counter}: {'; '.join(problems)}")
+            with db.transaction():
+                if entry and entry['campaign'] == name:
+                    # The file changed since we imported it, replace its levels
+                    for level in campaign_levels:
+                        db.delete(level)
+                elif campaign_levels:
+                    # Never overwrite a campaign someone uploaded under the same name
+                    continue
+                store_campaign(name, texts, user)
+                db.record_seed(path, {'stamp': stamp, 'hash': digest, 'campaign': name})
+        except LevelFormatError as e:
+            # Skip the file until it changes again; levels imported from an
+            # earlier version of it stay as they were
+            print(f"Not importing {path}: {e}")
+            db.record_seed(path, {'stamp': stamp, 'hash': digest,
+                                  'campaign': entry['campaign'] if entry else None})
+
+def watch_campaigns(interval):
+    # Re-seed whenever a bundled campaign file changes on disk
+    def poll():
+        while True:
+            time.sleep(interval)
+            try:
+                seed_campaigns()
+            except Exception as e:
+                print(f"Error seeding campaigns: {e}")
+    thread = threading.Thread(target=poll, name='campaign-watcher', daemon=True)
+    thread.start()
+    return thread
+
+seed_campaigns()
+if os.environ.get('SLASHA_WATCH_DATA'):
+    watch_campaigns(float(os.environ['SLASHA_WATCH_DATA']))
+
 # Create a proper Flask template renderer
 @app.template_filter('render_template_string')
 def render_template_string_filter(template_string, **context):
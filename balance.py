@@ -0,0 +1,197 @@
+import os
+import json
+import random
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from level_format import parse_level, LevelFormatError
+from render_cache import RenderCache
+from simulator import Battle, SimulationError, load_level
+
+# Balance reports for levels: many simulated battles, each with a player
+# making seeded random decisions, and what share of them the player wins
+# with how many losses. The battle engine itself has no randomness, so the
+# seed picks the player's moves; the same level, seed and settings always
+# give the same report.
+#
+#   python balance.py data/rebellion.txt 3 -n 200 --set soldier.damage=10
+#
+# plays level 3 of a campaign file (or of a stored campaign, when the name
+# is not a file) with the soldiers' damage changed, without editing the
+# level.
+
+# Reports by content hash of the level and the settings, so editing a level
+# makes a new key; in memory for the app, and on disk for the command line
+REPORT_CACHE_DIR = '.balance'
+reports = RenderCache(4 * 1024 * 1024, sizeof=lambda report: len(json.dumps(report)))
+
+def report_key(text, battles, seed, max_ticks, overrides):
+    h = hashlib.sha1()
+    h.update(text.encode('utf-8'))
+    h.update(json.dumps([battles, seed, max_ticks, overrides], sort_keys=True).encode('utf-8'))
+    return h.hexdigest()
+
+def apply_overrides(parsed, overrides):
+    # overrides: {class: {attribute: value}}
+    for uclass, attributes in (overrides or {}).items():
+        if uclass not in parsed.classes:
+            raise SimulationError(f"unknown unit class '{uclass}'")
+        parsed.classes[uclass].update(attributes)
+    return parsed
+
+def play(battle, rng):
+    # One decision of the simulated player: send a group of their units at
+    # an enemy or somewhere on the map, change its mode, or mark an enemy
+    friends = [u for u in battle.units if u.side == 1 and u.aitype > 0]
+    enemies = [u for u in battle.units if u.side != 1]
+    if not friends:
+        return
+    r = rng.random()
+    if r < 0.1 and enemies:
+        battle.command('select', [rng.choice(enemies).id])
+        battle.command('target', 1)
+        return
+    group = rng.sample(friends, rng.randint(1, len(friends)))
+    battle.command('select', [u.id for u in group])
+    if r < 0.25:
+        battle.command('mode', rng.randint(1, 4))
+    elif enemies and r < 0.75:
+        target = rng.choice(enemies)
+        battle.command('send', target.nx, target.ny, rng.random() < 0.3)
+    else:
+        cells = [c for c, passable in enumerate(battle.passable) if passable]
+        x, y = divmod(rng.choice(cells), battle.terrain.shape[1])
+        battle.command('send', x, y, rng.random() < 0.3)
+
+def simulate(job):
+    text, seed, max_ticks, overrides = job
+    battle = Battle(apply_overrides(parse_level(text), overrides), start_time=0)
+    rng = random.Random(seed)
+    decide_at = 0
+    while battle.result is None and battle.ticks < max_ticks:
+        if battle.time >= decide_at:
+            play(battle, rng)
+            decide_at = battle.time + rng.randint(20, 120)
+        battle.update()
+    return seed, battle.result.score() if battle.result else None
+
+def summary(values):
+    if not values:
+        return None
+    values = sorted(values)
+    counts = {}
+    for v in values:
+        counts[v] = counts.get(v, 0) + 1
+
+    def at(q):
+        return values[min(int(q * len(values)), len(values) - 1)]
+    return {'mean': round(sum(values) / len(values), 2), 'min': values[0], 'p10': at(0.1),
+            'median': at(0.5), 'p90': at(0.9), 'max': values[-1],
+            'histogram': [[v, n] for v, n in counts.items()]}
+
+def make_report(outcomes):
+    finished = [(seed, score) for seed, score in outcomes if score is not None]
+    wins = [score for _, score in finished if score[0] == 1]
+    losses = [score for _, score in finished if score[0] == 0]
+    report = {
+        'battles': len(outcomes),
+        'wins': len(wins),
+        'losses': len(losses),
+        'timeouts': len(outcomes) - len(finished),
+        'win_rate': round(len(wins) / len(outcomes), 4) if outcomes else 0,
+        'friendly_losses': summary([score[1] for _, score in finished]),
+        'enemy_losses': summary([score[2] for _, score in finished]),
+        'win_time': summary([score[3] for score in wins]),
+    }
+    if wins:
+        # The cheapest win, to replay and look at
+        report['best_seed'] = min((score[1], score[3], seed) for seed, score in finished if score[0] == 1)[2]
+    return report
+
+def evaluate(text, battles=200, seed=0, max_ticks=5000, overrides=None, processes=None, cache_dir=None):
+    key = report_key(text, battles, seed, max_ticks, overrides)
+    report = reports.get(key)
+    if report is not None:
+        return report
+    path = os.path.join(cache_dir, key + '.json') if cache_dir else None
+    if path and os.path.exists(path):
+        with open(path) as file:
+            return reports.put(key, json.load(file))
+
+    # Fail early on levels the simulator cannot run
+    apply_overrides(parse_level(text), overrides)
+    jobs = [(text, s, max_ticks, overrides) for s in range(seed, seed + battles)]
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        outcomes = list(pool.map(simulate, jobs))
+    report = make_report(outcomes)
+    report.update({'seed': seed, 'max_ticks': max_ticks, 'overrides': overrides or {}})
+
+    if path:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as file:
+            json.dump(report, file, indent=1)
+        os.replace(tmp, path)
+    return reports.put(key, report)
+
+def stored_level(campaign, counter):
+    # The level as the app stores it, from the database SLASHA_DB names
+    from app import db, Level
+    levels = db.query(Level, campaign=campaign, counter=counter)
+    if not levels:
+        raise SimulationError(f"campaign '{campaign}' has no level {counter}")
+    return levels[0].text
+
+def parse_override(text):
+    # class.attribute=value
+    try:
+        name, value = text.split('=', 1)
+        uclass, attribute = name.rsplit('.', 1)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected class.attribute=value, not '{text}'")
+    if attribute not in ('desc', 'image'):
+        value = float(value)
+    return uclass, attribute, value
+
+def print_report(report):
+    print(f"{report['battles']} battles: {report['wins']} won, {report['losses']} lost, "
+          f"{report['timeouts']} undecided after {report['max_ticks']} ticks (win rate {report['win_rate']:.1%})")
+    for name in ('friendly_losses', 'enemy_losses', 'win_time'):
+        s = report[name]
+        if s:
+            print(f"{name:16} mean {s['mean']:8} min {s['min']:6} p10 {s['p10']:6} median {s['median']:6} "
+                  f"p90 {s['p90']:6} max {s['max']:6}")
+    if 'best_seed' in report:
+        print(f"cheapest win: seed {report['best_seed']}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Report how winnable a level is from many simulated battles')
+    parser.add_argument('campaign', help='campaign file, e.g. data/tutorial.txt, or the name of a stored campaign')
+    parser.add_argument('level', type=int, help='level number, counting from 1')
+    parser.add_argument('-n', '--battles', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0, help='seed of the first battle')
+    parser.add_argument('--max-ticks', type=int, default=5000)
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='worker processes (default: one per core)')
+    parser.add_argument('--set', dest='overrides', action='append', type=parse_override, default=[],
+                        metavar='CLASS.ATTRIBUTE=VALUE', help='change a unit class for these battles')
+    parser.add_argument('--no-cache', action='store_true', help='ignore and do not write cached reports')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args()
+
+    overrides = {}
+    for uclass, attribute, value in args.overrides:
+        overrides.setdefault(uclass, {})[attribute] = value
+    try:
+        if os.path.isfile(args.campaign):
+            text = load_level(args.campaign, args.level)
+        else:
+            text = stored_level(args.campaign, args.level)
+        report = evaluate(text, args.battles, args.seed, args.max_ticks, overrides, args.jobs,
+                          None if args.no_cache else REPORT_CACHE_DIR)
+    except (SimulationError, LevelFormatError) as e:
+        parser.error(str(e))
+    if args.json:
+        print(json.dumps(report, indent=1))
+    else:
+        print_report(report)
@@ -0,0 +1,27 @@
+import multiprocessing
+import os
+
+# Multi-worker deployment: gunicorn -c gunicorn.conf.py app:app
+#
+# Every worker is a separate process, so they all need the same session
+# signing key and the same database; both must be given in the environment.
+if not os.environ.get('SLASHA_SECRET_KEY'):
+    raise RuntimeError("SLASHA_SECRET_KEY must be set, the workers cannot share a made up one")
+# Anything but SQLite would give every worker a database of its own
+if not os.environ.get('SLASHA_DB', '').startswith('sqlite:///'):
+    raise RuntimeError("SLASHA_DB must be a sqlite:///path/to/file.db the workers share")
+
+bind = '0.0.0.0:' + os.environ.get('PORT', '8080')
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+
+# Import the app once in the master so bundled campaigns are seeded once;
+# the workers fork from it and open their own database connections
+preload_app = True
+
+def pre_fork(server, worker):
+    # Close the master's connections so no worker inherits an open one
+    from app import db
+    db.close()
+
+# The directory of the database may not exist yet
+os.makedirs(os.path.dirname(os.path.abspath(os.environ['SLASHA_DB'][len('sqlite:///'):])), exist_ok=True)
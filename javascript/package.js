@@ -33,6 +33,22 @@ function textify_events() {
 function textify_terrain() {
   replace_text_block("terrain",JSON.stringify(terrain));
 }
+//Terrain sent as "rle:" + base64 of [version, width, height, (run, value) pairs...]
+function decode_terrain(text) {
+  var b = atob(text.substring(4));
+  var w = b.charCodeAt(1);
+  var h = b.charCodeAt(2);
+  var terrain = [];
+  for (var x = 0; x < w; x++) terrain.push([]);
+  var x = 0;
+  for (var i = 3; i + 1 < b.length; i += 2) {
+    for (var r = 0; r < b.charCodeAt(i); r++) {
+      terrain[x].push(b.charCodeAt(i + 1));
+      if (terrain[x].length == h) x++;
+    }
+  }
+  return terrain;
+}
 function unpack_level() {
   var d = document.getElementsByName('data')[0];
   var lines = d.value.split('\n');
@@ -48,7 +64,7 @@ function unpack_level() {
     else if (at == "##events##" && lines[i] != "") events_text.push(lines[i]);
     else if (at == "##terrain##" && lines[i] != "") terrain_text = lines[i];
   }
-  var terrain = JSON.parse(terrain_text);
+  var terrain = terrain_text.substring(0,4) == "rle:" ? decode_terrain(terrain_text) : JSON.parse(terrain_text);
   var classes = {};
   var events = [];
   for (var i = 0; i < classes_text.length; i++) {
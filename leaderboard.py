@@ -0,0 +1,72 @@
+import bisect
+import threading
+
+# Metrics shown in the high-score block of a level. Each one is
+# (value of a winning result, sign, default): a sign of 1 means lower is
+# better and -1 means higher is better. Only results that beat the default
+# get on the board, which matches what the page showed before.
+METRICS = {
+    'minloss': (lambda r: r.friendly_losses, 1, 99999),
+    'maxratio': (lambda r: r.enemy_losses / (r.friendly_losses + 0.01), -1, 0),
+    'mintime': (lambda r: r.time, 1, 99999),
+    'minrt': (lambda r: r.realtime * 0.001, 1, 99999),
+}
+
+# Incrementally maintained high scores per (campaign, counter). Every metric
+# keeps its best `size` entries sorted, so reading the page's records is a
+# single keyed lookup no matter how many games were played on the level.
+# Each board also has a version that changes whenever its entries do, so
+# pages showing the records can be cached against it.
+class Leaderboard:
+    def __init__(self, size=10):
+        self.size = size
+        self.boards = {}
+        self.versions = {}
+        self.seq = 0
+        self.last_key = 0
+        self.lock = threading.RLock()
+
+    def record(self, result):
+        if result.win != 1:
+            return
+        with self.lock:
+            key = (result.campaign, result.counter)
+            board = self.boards.setdefault(key, {m: [] for m in METRICS})
+            # Earlier results win ties, like the old scan with strict comparisons
+            self.seq += 1
+            for name, (value_of, sign, default) in METRICS.items():
+                value = value_of(result)
+                if sign * value >= sign * default:
+                    continue
+                entries = board[name]
+                entry = (sign * value, self.seq, value, result.nick)
+                if len(entries) < self.size or entry < entries[-1]:
+                    bisect.insort(entries, entry)
+                    del entries[self.size:]
+                    self.versions[key] = self.seq
+
+    def catch_up(self, db):
+        # Fold in the winning results stored since the last call, by this or
+        # any other process sharing the database
+        with self.lock:
+            for result in db.results_since(self.last_key):
+                self.record(result)
+                self.last_key = result.key
+
+    def version(self, campaign, counter):
+        return self.versions.get((campaign, counter), 0)
+
+    def top(self, campaign, counter, metric, n=None):
+        board = self.boards.get((campaign, counter))
+        if not board:
+            return []
+        return [[value, nick] for _, _, value, nick in board[metric][:n]]
+
+    def best(self, campaign, counter):
+        # [value, nick] per metric, falling back to the page defaults
+        board = self.boards.get((campaign, counter), {})
+        records = {}
+        for name, (_, _, default) in METRICS.items():
+            entries = board.get(name)
+            records[name] = [entries[0][2], entries[0][3]] if entries else [default, "null"]
+        return records
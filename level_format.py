@@ -0,0 +1,339 @@
+import json
+import base64
+import hashlib
+import threading
+from array import array
+from collections import OrderedDict
+
+# Size of the battlefield, see FIELDW and FIELDH in javascript/main.js
+FIELDW = 40
+FIELDH = 30
+
+# Prefix of a terrain line in the compact format, see encode_terrain()
+COMPACT_PREFIX = "rle:"
+
+class LevelFormatError(ValueError):
+    pass
+
+# A level parsed once into its typed parts. The raw text is kept as is so
+# the level round-trips exactly, and `offsets` maps every ##section## to the
+# (start, end) character range of its body in that text.
+#
+# Terrain is stored x-major like the JSON grid (cell (x, y) is at
+# x * height + y): as bytes when every cell is an integer in 0-255, which is
+# the case for nearly every level, and as an array of doubles otherwise.
+class ParsedLevel:
+    def __init__(self, text, story, classes, events, terrain, width, height, offsets):
+        self.text = text
+        self.story = story
+        self.classes = classes
+        self.events = events
+        self.terrain = terrain
+        self.width = width
+        self.height = height
+        self.offsets = offsets
+
+    def section(self, name):
+        if name not in self.offsets:
+            return None
+        start, end = self.offsets[name]
+        return self.text[start:end]
+
+    def cell(self, x, y):
+        return self.terrain[x * self.height + y]
+
+    def terrain_rows(self):
+        h = self.height
+        return [list(self.terrain[x * h:(x + 1) * h]) for x in range(self.width)]
+
+    def terrain_json(self, separators=(',', ':')):
+        return json.dumps(self.terrain_rows(), separators=separators)
+
+def pack_terrain(grid):
+    # Flatten the JSON grid into the compact x-major representation
+    if not isinstance(grid, list) or not all(isinstance(column, list) for column in grid):
+        raise LevelFormatError("terrain is not a list of columns")
+    height = len(grid[0]) if grid else 0
+    if any(len(column) != height for column in grid):
+        raise LevelFormatError("terrain columns differ in length")
+    cells = [v for column in grid for v in column]
+    if not all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in cells):
+        raise LevelFormatError("terrain cells must be numbers")
+    if all(isinstance(v, int) and 0 <= v <= 255 for v in cells):
+        return bytes(cells), len(grid), height
+    return array('d', cells), len(grid), height
+
+def parse_level(text):
+    # Same reading rules as unpack_level() in javascript/package.js
+    story = []
+    classes = {}
+    events = []
+    terrain_text = None
+    offsets = {}
+    at = None
+    pos = 0
+    for n, line in enumerate(text.split('\n'), 1):
+        start = pos
+        pos += len(line) + 1
+        if line[:2] == "##" and line[-2:] == "##" and len(line) >= 4:
+            if at is not None:
+                offsets[at] = (offsets[at][0], start)
+            at = line[2:-2]
+            offsets[at] = (min(pos, len(text)), len(text))
+        elif line == "":
+            continue
+        elif at == "story":
+            story.append(line)
+        elif at == "classes":
+            name = line[:line.find(' ')] if ' ' in line else line
+            brace = line.find('{')
+            if brace < 0:
+                raise LevelFormatError(f"line {n}: class '{name}' has no attributes")
+            try:
+                classes[name] = json.loads(line[brace:].replace("'", '"'))
+            except ValueError as e:
+                raise LevelFormatError(f"line {n}: bad attributes for class '{name}': {e}")
+        elif at == "events":
+            events.append(tuple(line.split(' ')))
+        elif at == "terrain":
+            terrain_text = line
+
+    if terrain_text is None:
+        terrain, width, height = b'', 0, 0
+    elif terrain_text.startswith(COMPACT_PREFIX):
+        terrain, width, height, _ = decode_terrain(terrain_text)
+    else:
+        try:
+            grid = json.loads(terrain_text)
+        except ValueError as e:
+            raise LevelFormatError(f"bad terrain: {e}")
+        terrain, width, height = pack_terrain(grid)
+
+    return ParsedLevel(text, ''.join(story), classes, events, terrain, width, height, offsets)
+
+# JSON separators of the terrain grids found in level files, by the version
+# byte that records them in the compact format: JSON.stringify() output as
+# written by the editor, and Python's json.dumps() default
+TERRAIN_STYLES = {1: (',', ':'), 2: (', ', ': ')}
+
+# Compact terrain format: "rle:" followed by base64 of a version byte, the
+# width and height, then (run length, cell value) byte pairs over the
+# x-major cells. Only byte terrain is encoded; the 1200-cell JSON grid of a
+# typical level shrinks from 3-5 KB to a few hundred bytes.
+def encode_terrain(terrain, width, height, style=1):
+    if not isinstance(terrain, bytes) or width > 255 or height > 255:
+        return None
+    out = bytearray((style, width, height))
+    i = 0
+    while i < len(terrain):
+        value = terrain[i]
+        run = 1
+        while run < 255 and i + run < len(terrain) and terrain[i + run] == value:
+            run += 1
+        out += bytes((run, value))
+        i += run
+    return COMPACT_PREFIX + base64.b64encode(bytes(out)).decode('ascii')
+
+def decode_terrain(line):
+    try:
+        data = base64.b64decode(line[len(COMPACT_PREFIX):], validate=True)
+    except ValueError as e:
+        raise LevelFormatError(f"bad compact terrain: {e}")
+    if len(data) < 3 or data[0] not in TERRAIN_STYLES or len(data) % 2 != 1:
+        raise LevelFormatError("bad compact terrain header")
+    style, width, height = data[0], data[1], data[2]
+    cells = bytearray()
+    for i in range(3, len(data), 2):
+        cells += bytes((data[i + 1],)) * data[i]
+    if len(cells) != width * height:
+        raise LevelFormatError("compact terrain does not fill its grid")
+    return bytes(cells), width, height, style
+
+def _terrain_line(text):
+    # (start, end) of the line parse_level() takes the terrain from
+    at = None
+    found = None
+    pos = 0
+    for line in text.split('\n'):
+        start = pos
+        pos += len(line) + 1
+        if line[:2] == "##" and line[-2:] == "##" and len(line) >= 4:
+            at = line[2:-2]
+        elif line != "" and at == "terrain":
+            found = (start, start + len(line))
+    return found
+
+def compact_level_text(text):
+    # Swap the JSON terrain line for the compact encoding, but only when
+    # expanding it again gives back exactly the same characters
+    span = _terrain_line(text)
+    if span is None:
+        return text
+    line = text[span[0]:span[1]]
+    if line.startswith(COMPACT_PREFIX):
+        return text
+    try:
+        terrain, width, height = pack_terrain(json.loads(line))
+    except (ValueError, LevelFormatError):
+        return text
+    parsed = ParsedLevel(text, '', {}, [], terrain, width, height, {})
+    for style, separators in TERRAIN_STYLES.items():
+        if parsed.terrain_json(separators) == line:
+            encoded = encode_terrain(terrain, width, height, style)
+            if encoded is not None:
+                return text[:span[0]] + encoded + text[span[1]:]
+    return text
+
+def expand_level_text(text):
+    # Inverse of compact_level_text(). Text with a JSON terrain, or with a
+    # compact terrain that does not decode, is returned as is.
+    span = _terrain_line(text)
+    if span is None or not text.startswith(COMPACT_PREFIX, span[0]):
+        return text
+    try:
+        terrain, width, height, style = decode_terrain(text[span[0]:span[1]])
+    except LevelFormatError:
+        return text
+    parsed = ParsedLevel(text, '', {}, [], terrain, width, height, {})
+    expanded = parsed.terrain_json(TERRAIN_STYLES[style])
+    return text[:span[0]] + expanded + text[span[1]:]
+
+# Campaign packages are the campaign name on the first line ("Campaign:
+# <name>") followed by levels, each introduced by a line of dashes. This
+# reads one from a text stream (or any iterable of lines) a line at a time,
+# returning the name and a generator of level texts, so a pack never has to
+# be held in memory whole.
+def read_campaign(stream):
+    stream = iter(stream)
+    first = next(stream, '').replace('\r', '')
+    if first.endswith('\n'):
+        first = first[:-1]
+    return first[first.find(": ") + 2:], _campaign_levels(stream)
+
+def _campaign_levels(stream):
+    lines = None
+    line = ''
+    for line in stream:
+        line = line.replace('\r', '')
+        text = line[:-1] if line.endswith('\n') else line
+        if "--------" in text:
+            if lines is not None:
+                yield '\n'.join(lines)
+            lines = []
+        elif lines is not None:
+            lines.append(text)
+    if lines is not None:
+        # A pack ending in a newline ends its last level with one too
+        if line.endswith('\n'):
+            lines.append('')
+        yield '\n'.join(lines)
+
+# Level text cut in front of every ##section## line. The pieces join back
+# into exactly the same text, and levels sharing a section (the classes of
+# a campaign, a terrain, the default level) share the piece, so storage
+# keeps each distinct piece once under its chunk_key().
+def split_sections(text):
+    pieces = []
+    start = 0
+    pos = 0
+    for line in text.split('\n'):
+        if pos > 0 and line[:2] == "##" and line[-2:] == "##" and len(line) >= 4:
+            pieces.append(text[start:pos])
+            start = pos
+        pos += len(line) + 1
+    if text:
+        pieces.append(text[start:])
+    return pieces
+
+def chunk_key(piece):
+    return hashlib.sha1(piece.encode('utf-8')).hexdigest()
+
+# Attributes of a unit class the game reads as numbers or as text, see
+# class_template in javascript/main.js
+NUMERIC_ATTRIBUTES = ('side', 'aitype', 'damage', 'health', 'range', 'speed', 'cmult', 'bmult', 'inacc')
+TEXT_ATTRIBUTES = ('desc', 'image')
+
+# Words the events of a fixed form need at least; the game ignores any
+# further words, which bundled levels use for notes
+EVENT_ARITY = {'unit': 4, 'xunit': 4, 'win': 1, 'lose': 1, 'setr': 3, 'changer': 3, 'setup': 5}
+
+# Results of check_level() by content hash, so a level is only checked
+# again when its text changes
+CHECKED_LEVELS = 4096
+_checked = OrderedDict()
+_checked_lock = threading.Lock()
+
+def check_level(text):
+    # Everything about a level that would break it in the browser, as a
+    # tuple of messages; empty when the level is fine
+    key = hashlib.sha1(text.encode('utf-8')).digest()
+    with _checked_lock:
+        problems = _checked.get(key)
+        if problems is not None:
+            _checked.move_to_end(key)
+            return problems
+    problems = tuple(_level_problems(text))
+    with _checked_lock:
+        _checked[key] = problems
+        if len(_checked) > CHECKED_LEVELS:
+            _checked.popitem(last=False)
+    return problems
+
+def _level_problems(text):
+    try:
+        parsed = parse_level(text)
+    except LevelFormatError as e:
+        yield str(e)
+        return
+    for name, spec in parsed.classes.items():
+        if not isinstance(spec, dict):
+            yield f"class '{name}' attributes are not an object"
+            continue
+        for attribute in NUMERIC_ATTRIBUTES:
+            value = spec.get(attribute, 0)
+            if not isinstance(value, (int, float)) or isinstance(value, bool):
+                yield f"class '{name}': {attribute} must be a number"
+        for attribute in TEXT_ATTRIBUTES:
+            if not isinstance(spec.get(attribute, ''), str):
+                yield f"class '{name}': {attribute} must be text"
+    for n, event in enumerate(parsed.events, 1):
+        for problem in _event_problems(list(event), parsed.classes):
+            yield f"event {n} ({' '.join(event)}): {problem}"
+    if parsed.height == 0:
+        yield "the level has no terrain"
+    elif (parsed.width, parsed.height) != (FIELDW, FIELDH):
+        yield f"terrain is {parsed.width}x{parsed.height}, not {FIELDW}x{FIELDH}"
+
+def _event_problems(event, classes):
+    kind = event[0]
+    if kind in EVENT_ARITY and len(event) < EVENT_ARITY[kind]:
+        yield f"'{kind}' needs {EVENT_ARITY[kind] - 1} arguments"
+        return
+    # Words holding registers (_name_) only get their value in the game
+    fixed = [word for word in event if '_' not in word]
+    if kind in ('unit', 'xunit'):
+        if event[1] in fixed and event[1] not in classes:
+            yield f"unknown unit class '{event[1]}'"
+        for word, size in ((event[2], FIELDW), (event[3], FIELDH)):
+            if word in fixed and not _number_in(word, 0, size):
+                yield f"'{word}' is not a position on the field"
+    elif kind == 'setup':
+        for word, size in zip(event[1:], (FIELDW, FIELDH, FIELDW, FIELDH)):
+            if word in fixed and not _number_in(word, 0, size + 1):
+                yield f"'{word}' is not a position on the field"
+    elif kind in ('when', 'whenever'):
+        if 'do' not in event or event.index('do') == len(event) - 1:
+            yield f"'{kind}' needs 'do' followed by an event"
+        else:
+            # The part after "do" runs as an event of its own
+            yield from _event_problems(event[event.index('do') + 1:], classes)
+    elif kind in ('set', 'change'):
+        if 'attribute' not in event or len(event) - event.index('attribute') < 3:
+            yield f"'{kind}' needs 'attribute' followed by a name and a value"
+
+def _number_in(word, low, high):
+    try:
+        value = float(word)
+    except ValueError:
+        return False
+    return low <= value < high
@@ -2,29 +2,148 @@ from google.cloud import ndb
 import os
 import pickle
 import json
+import struct
+import zlib
+import atexit
+import contextlib
 from datetime import datetime
 
-# In-memory database for local development
+# Every record in the log is framed as (payload length, crc32) + pickle
+RECORD_HEADER = struct.Struct('<II')
+
+# Marks an entity that did not exist before a transaction wrote it
+MISSING = object()
+
+# In-memory database for local development. The state on disk is a snapshot
+# plus an append-only log of the mutations made since it was written, so a
+# write only costs the size of the record written. Once the log has grown
+# past `compact_after` records it is folded into a fresh snapshot.
 class LocalDB:
-    def __init__(self):
+    def __init__(self, path='local_db.pickle', log_path='local_db.log', compact_after=1000):
         self.data = {}
+        self.path = path
+        self.log_path = log_path
+        self.compact_after = compact_after
+        self.log = None
+        self.log_records = 0
+        self.pending = None
+        self.undo = None
         self.load_from_disk()
     
     def load_from_disk(self):
         try:
-            if os.path.exists('local_db.pickle'):
-                with open('local_db.pickle', 'rb') as f:
+            if os.path.exists(self.path):
+                with open(self.path, 'rb') as f:
                     self.data = pickle.load(f)
         except Exception as e:
             print(f"Error loading database: {e}")
             self.data = {}
+        self.replay_log()
+        self.log = open(self.log_path, 'ab')
+    
+    def replay_log(self):
+        if not os.path.exists(self.log_path):
+            return
+        good = 0
+        with open(self.log_path, 'rb') as f:
+            while True:
+                header = f.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    break
+                length, crc = RECORD_HEADER.unpack(header)
+                payload = f.read(length)
+                if len(payload) < length or zlib.crc32(payload) != crc:
+                    break
+                good = f.tell()
+                self.log_records += 1
+                try:
+                    self.apply(pickle.loads(payload))
+                except Exception as e:
+                    print(f"Error replaying log record: {e}")
+            size = f.seek(0, os.SEEK_END)
+        # A record torn by a crash mid-append is dropped, everything before it is kept
+        if good < size:
+            print(f"Discarding {size - good} bytes of incomplete log records")
+            with open(self.log_path, 'r+b') as f:
+                f.truncate(good)
+    
+    def apply(self, record):
+        op, kind, entity_id = record[:3]
+        if op == 'put':
+            self.data.setdefault(kind, {})[entity_id] = record[3]
+        elif op == 'delete':
+            self.data.get(kind, {}).pop(entity_id, None)
+    
+    def write(self, record):
+        # Apply a mutation and log it, or hold the log record back until the
+        # surrounding transaction commits
+        if self.pending is not None:
+            kind, entity_id = record[1], record[2]
+            self.undo.append((kind, entity_id, self.data.get(kind, {}).get(entity_id, MISSING)))
+        self.apply(record)
+        payload = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+        frame = RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+        if self.pending is not None:
+            self.pending.append(frame)
+        else:
+            self.append([frame])
+    
+    def append(self, frames):
+        self.log.write(b''.join(frames))
+        self.log.flush()
+        os.fsync(self.log.fileno())
+        self.log_records += len(frames)
+        if self.log_records >= self.compact_after:
+            self.save_to_disk()
+    
+    @contextlib.contextmanager
+    def transaction(self):
+        # Group writes into one log append and one fsync. If the block raises,
+        # nothing reaches the log and the in-memory changes are rolled back.
+        if self.pending is not None:
+            yield self
+            return
+        self.pending = []
+        self.undo = []
+        try:
+            yield self
+        except BaseException:
+            for kind, entity_id, old in reversed(self.undo):
+                if old is MISSING:
+                    self.data.get(kind, {}).pop(entity_id, None)
+                else:
+                    self.data.setdefault(kind, {})[entity_id] = old
+            raise
+        else:
+            if self.pending:
+                self.append(self.pending)
+        finally:
+            self.pending = None
+            self.undo = None
     
     def save_to_disk(self):
+        # Write the snapshot next to the old one and rename it into place, so
+        # a crash leaves either the old or the new snapshot intact; only then
+        # is the log, now folded into the snapshot, emptied
+        tmp_path = self.path + '.tmp'
         try:
-            with open('local_db.pickle', 'wb') as f:
-                pickle.dump(self.data, f)
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(self.data, f, pickle.HIGHEST_PROTOCOL)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
         except Exception as e:
             print(f"Error saving database: {e}")
+            return
+        self.log.close()
+        self.log = open(self.log_path, 'wb')
+        self.log_records = 0
+    
+    def close(self):
+        if self.log is not None and not self.log.closed:
+            if self.log_records:
+                self.save_to_disk()
+            self.log.close()
     
     def put(self, entity):
         kind = entity.__class__.__name__
@@ -36,10 +155,13 @@ class LocalDB:
             entity.id = len(self.data[kind]) + 1
         
         # Store the entity
-        self.data[kind][entity.id] = entity
-        self.save_to_disk()
+        self.write(('put', kind, entity.id, entity))
         return entity.id
     
+    def put_multi(self, entities):
+        with self.transaction():
+            return [self.put(entity) for entity in entities]
+    
     def get(self, kind, entity_id):
         if kind in self.data and entity_id in self.data[kind]:
             return self.data[kind][entity_id]
@@ -47,8 +169,7 @@ class LocalDB:
     
     def delete(self, kind, entity_id):
         if kind in self.data and entity_id in self.data[kind]:
-            del self.data[kind][entity_id]
-            self.save_to_disk()
+            self.write(('delete', kind, entity_id))
             return True
         return False
     
@@ -96,6 +217,7 @@ class LocalDB:
 
 # Global database instance
 local_db = LocalDB()
+atexit.register(local_db.close)
 
 # Mock context manager for NDB
 class MockContext:
@@ -121,6 +243,9 @@ def monkey_patch_ndb():
     def mock_put(self, *args, **kwargs):
         return local_db.put(self)
     
+    def mock_put_multi(entities, *args, **kwargs):
+        return local_db.put_multi(entities)
+    
     def mock_query(self, *args, **kwargs):
         # Simplified mock query implementation
         kind = self._kind
@@ -138,4 +263,5 @@ def monkey_patch_ndb():
         return results
     
     ndb.Model.put = mock_put
+    ndb.put_multi = mock_put_multi
     ndb.query.Query._execute_query = mock_query
\ No newline at end of file
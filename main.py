@@ -1,6 +1,8 @@
-import os, datetime
+import os, io, datetime
 from flask import Flask, request, render_template_string, redirect, url_for, session
 import json
+from static_assets import Documents, send_asset
+from level_format import read_campaign
 
 app = Flask(__name__)
 app.secret_key = 'your-secret-key-here'
@@ -71,19 +73,22 @@ def logout():
     session.clear()
     return redirect('/')
 
+# devguide.html and tutorial.txt, served from memory
+documents = Documents(os.path.dirname(os.path.abspath(__file__)))
+
 @app.route('/devguide')
 def devguide():
-    try:
-        return open('devguide.html').read()
-    except:
+    doc = documents.get('devguide.html')
+    if doc is None:
         return "<h1>Dev Guide</h1><p>Development guide not found</p>"
+    return send_asset(app, request, doc)
 
 @app.route('/example')
 def example():
-    try:
-        return open('tutorial.txt').read()
-    except:
+    doc = documents.get('tutorial.txt')
+    if doc is None:
         return "Tutorial file not found"
+    return send_asset(app, request, doc)
 
 @app.route('/startscreen', methods=['GET', 'POST'])
 def startscreen():
@@ -180,18 +185,13 @@ def create_level(text, campaign, counter, owner, nick):
     levels_db.append(level)
     return level
 
+def put_multi(levels):
+    levels_db.extend(levels)
+    return levels
+
 def load_campaign(pkg, user_id, nickname):
-    lines = pkg.replace("\r", "").split("\n")
-    name = lines[0][lines[0].find(": ") + 2:]
-    breaks = []
-    for i, line in enumerate(lines[1:], 1):
-        if "--------" in line:
-            breaks.append(i)
-    breaks.append(len(lines))
-    
-    for i in range(len(breaks) - 1):
-        level_text = '\n'.join(lines[breaks[i] + 1:breaks[i + 1]])
-        create_level(level_text, name, i + 1, user_id, nickname)
+    name, texts = read_campaign(io.StringIO(pkg))
+    put_multi([Level(text, i, name, user_id, nickname) for i, text in enumerate(texts, 1)])
 
 @app.route('/play', methods=['GET', 'POST'])
 def game():
@@ -19,20 +19,176 @@ init_vars += "campaign = '" + campaign + "';\ncounter = " + str(counter) + ";\n"
 campaign = ""
 
 import os
-if 'levels' not in os.listdir():
-    os.mkdir('levels')
-index = ['<h3>Campaigns</h3>']
-for filename in os.listdir('data'):
-    if filename[-4:] == '.txt':
-        campaign_name = filename[:-4]
-        if campaign_name not in os.listdir('levels'):
-            os.mkdir(os.path.join('levels', campaign_name))
-        levels = open(os.path.join('data', filename)).read().split('\n-----------------------\n')[1:]
-        index.append('<a href="levels/{0}/0.html">{0}</a>'.format(campaign_name))
-        for i, level in enumerate(levels):
-            current_location = os.path.join('levels', campaign_name, str(i))+'.html'
-            next_location = os.path.join('levels', campaign_name, str(i+1))+'.html' if i < len(levels)-1 else 'index.html'
-            location_setter_script = 'current_location = "../../{}"; next_location = "../../{}";'.format(current_location, next_location)
-            level_html = open('template.html').read() % (init_vars, "../../javascript/main.js", location_setter_script, level, campaign)
-            open(current_location, 'w').write(level_html)
-open('index.html', 'w').write('\n'.join(index))
+import time
+import json
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from level_format import compact_level_text
+
+DATA_DIR = 'data'
+OUT_DIR = 'levels'
+LEVEL_SEPARATOR = '\n-----------------------\n'
+
+# What the last build read and wrote. For every campaign file: the mtime and
+# size it was read at, and the input hash each of its pages was made from,
+# so a rebuild only reads changed campaigns and only formats changed pages.
+MANIFEST = os.path.join(OUT_DIR, '.manifest.json')
+MANIFEST_VERSION = 1
+
+def digest(*parts):
+    h = hashlib.sha1()
+    for part in parts:
+        h.update(part.encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+def write_if_changed(path, text):
+    # Leave outputs whose content is already right untouched, so their
+    # mtimes only move when they really change. New content is written to
+    # a temporary file and renamed over the old one, so readers never see
+    # a half-written page.
+    data = text.encode('utf-8')
+    try:
+        with open(path, 'rb') as file:
+            if hashlib.sha1(file.read()).digest() == hashlib.sha1(data).digest():
+                return False
+    except FileNotFoundError:
+        pass
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as file:
+        file.write(data)
+    os.replace(tmp, path)
+    return True
+
+def file_stamp(path):
+    stat = os.stat(path)
+    return f"{stat.st_mtime_ns}:{stat.st_size}"
+
+def remove_pages(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def build_campaign(filename, template, shared_hash, old_pages):
+    # Write the pages of one campaign whose inputs changed since they were
+    # built (old_pages maps page path to input hash), and remove the pages
+    # of levels that no longer exist. Returns (manifest entry, pages written).
+    campaign_name = filename[:-4]
+    path = os.path.join(DATA_DIR, filename)
+    os.makedirs(os.path.join(OUT_DIR, campaign_name), exist_ok=True)
+    stamp = file_stamp(path)
+    with open(path) as file:
+        levels = file.read().split(LEVEL_SEPARATOR)[1:]
+    pages = {}
+    written = 0
+    for i, level in enumerate(levels):
+        current_location = os.path.join(OUT_DIR, campaign_name, str(i))+'.html'
+        next_location = os.path.join(OUT_DIR, campaign_name, str(i+1))+'.html' if i < len(levels)-1 else 'index.html'
+        location_setter_script = 'current_location = "../../{}"; next_location = "../../{}";'.format(current_location, next_location)
+        input_hash = digest(shared_hash, location_setter_script, level)
+        pages[current_location] = input_hash
+        if old_pages.get(current_location) == input_hash and os.path.exists(current_location):
+            continue
+        level_html = template % (init_vars, "../../javascript/main.js", location_setter_script, compact_level_text(level), campaign)
+        written += write_if_changed(current_location, level_html)
+    remove_pages(set(old_pages) - set(pages))
+    return {'stamp': stamp, 'pages': pages}, written
+
+def load_manifest():
+    try:
+        with open(MANIFEST) as file:
+            manifest = json.load(file)
+    except (OSError, ValueError):
+        return None
+    return manifest if manifest.get('version') == MANIFEST_VERSION else None
+
+def build(jobs=None, force=False):
+    with open('template.html') as file:
+        template = file.read()
+    # Everything every page depends on besides its own level
+    shared_hash = digest(template, init_vars, campaign)
+    os.makedirs(OUT_DIR, exist_ok=True)
+    manifest = None if force else load_manifest()
+    if manifest is None or manifest['shared'] != shared_hash:
+        manifest = {'version': MANIFEST_VERSION, 'shared': shared_hash, 'campaigns': {}}
+    old = manifest['campaigns']
+
+    filenames = sorted(f for f in os.listdir(DATA_DIR) if f[-4:] == '.txt')
+    stale = []
+    for f in filenames:
+        entry = old.get(f)
+        if (entry is None or entry['stamp'] != file_stamp(os.path.join(DATA_DIR, f))
+                or not all(os.path.exists(page) for page in entry['pages'])):
+            stale.append(f)
+
+    campaigns = {f: old[f] for f in filenames if f not in stale}
+    old_pages = [old[f]['pages'] if f in old else {} for f in stale]
+    written = 0
+    if len(stale) > 1:
+        # Campaigns are independent, so each one is built in its own process
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            results = list(pool.map(build_campaign, stale, [template] * len(stale),
+                                    [shared_hash] * len(stale), old_pages))
+    else:
+        results = [build_campaign(f, template, shared_hash, pages) for f, pages in zip(stale, old_pages)]
+    for f, (entry, n) in zip(stale, results):
+        campaigns[f] = entry
+        written += n
+
+    # Campaign files that were deleted take their pages with them
+    for f in set(old) - set(filenames):
+        remove_pages(old[f]['pages'])
+        try:
+            os.rmdir(os.path.join(OUT_DIR, f[:-4]))
+        except OSError:
+            pass
+
+    index = ['<h3>Campaigns</h3>']
+    index += ['<a href="levels/{0}/0.html">{0}</a>'.format(f[:-4]) for f in filenames]
+    written += write_if_changed('index.html', '\n'.join(index))
+
+    manifest['campaigns'] = campaigns
+    write_if_changed(MANIFEST, json.dumps(manifest, indent=1, sort_keys=True))
+    total = sum(len(entry['pages']) for entry in campaigns.values())
+    print(f'{len(filenames)} campaigns ({len(stale)} rebuilt), {total} levels, {written} files written')
+
+def inputs_stamp():
+    # Changes whenever a campaign file or the template is added, removed or
+    # modified
+    paths = ['template.html'] + sorted(os.path.join(DATA_DIR, f) for f in os.listdir(DATA_DIR))
+    return [(path, file_stamp(path)) for path in paths]
+
+def watch(jobs=None, interval=1.0):
+    last = None
+    while True:
+        try:
+            stamp = inputs_stamp()
+            if stamp != last:
+                build(jobs)
+                last = stamp
+        except OSError as e:
+            # A file that is being saved can vanish for a moment
+            print(f'Build failed: {e}')
+        time.sleep(interval)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the static campaign pages in levels/')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='worker processes (default: one per core)')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='ignore the build manifest and check every page')
+    parser.add_argument('-w', '--watch', action='store_true',
+                        help='keep running and rebuild whenever data/ or template.html changes')
+    parser.add_argument('--interval', type=float, default=1.0,
+                        help='seconds between checks in watch mode')
+    args = parser.parse_args()
+    if args.watch:
+        try:
+            watch(args.jobs, args.interval)
+        except KeyboardInterrupt:
+            pass
+    else:
+        build(args.jobs, args.force)
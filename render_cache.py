@@ -0,0 +1,53 @@
+import threading
+from collections import OrderedDict
+
+# Rendered pages kept in least-recently-used order. Keys must name every
+# input of the page (see game() and editor() in app.py), so entries never
+# need invalidating: a changed level or leaderboard makes a new key and the
+# stale page simply ages out. The cache holds at most `max_bytes` as
+# measured by `sizeof`; pages bigger than a quarter of that are not cached.
+class RenderCache:
+    def __init__(self, max_bytes=32 * 1024 * 1024, sizeof=len):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.pages = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            page = self.pages.get(key)
+            if page is None:
+                self.misses += 1
+                return None
+            self.pages.move_to_end(key)
+            self.hits += 1
+            return page
+
+    def put(self, key, page):
+        cost = self.sizeof(page)
+        if cost > self.max_bytes // 4:
+            return page
+        with self.lock:
+            old = self.pages.pop(key, None)
+            if old is not None:
+                self.size -= self.sizeof(old)
+            self.pages[key] = page
+            self.size += cost
+            while self.size > self.max_bytes:
+                _, evicted = self.pages.popitem(last=False)
+                self.size -= self.sizeof(evicted)
+        return page
+
+    def render(self, key, build):
+        page = self.get(key)
+        if page is None:
+            page = self.put(key, build())
+        return page
+
+    def clear(self):
+        with self.lock:
+            self.pages.clear()
+            self.size = 0
@@ -0,0 +1,819 @@
+import re
+import math
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from level_format import FIELDW, FIELDH, parse_level, read_campaign
+from spatial_grid import SpatialGrid
+from render_cache import RenderCache
+
+# Headless port of the battle engine in javascript/main.js. Given a level and
+# a log of the player's commands it replays a game tick by tick and reports
+# the outcome the browser would have sent, so submitted results can be
+# checked on the server.
+#
+# The port follows the browser code step by step, quirks included, since
+# any difference changes who wins. The per-cell work (line of sight, the
+# threat and opportunity maps, the AI's distance maps) is done with NumPy
+# over the whole field; the order dependent parts (distance map flooding,
+# moving and attacking one unit after the other) stay plain loops like in
+# the browser. Math.acos and Math.log may round differently from Python's
+# in the last bit, so in rare cases a replay can drift from the browser.
+#
+# Input logs are lists of [tick, command, *args], applied before the update
+# running at game time `tick`:
+#   [t, 'select', [unit ids]]   select exactly these units
+#   [t, 'send', x, y]           move the selection to cell (x, y)
+#   [t, 'send', x, y, 1]        move it in formation
+#   [t, 'mode', n]              set the AI mode (1-4) of the selection
+#   [t, 'target', 1 or -1]      raise or lower the selection's target level
+#   [t, 'skip']                 the menu key, which skips the story
+
+W = FIELDW
+H = FIELDH
+N = W * H
+
+CLASS_TEMPLATE = {"side": 1, "aitype": 1, "damage": 8, "health": 50, "range": 25, "image": "Archer.png",
+                  "speed": 0.067, "desc": "", "cmult": 0.75, "bmult": 0.6, "inacc": 0}
+
+MOVEMENTS = [(0, -1), (1, -1), (1, 0), (1, 1), (0, 1), (-1, 1), (-1, 0), (-1, -1)]
+
+# Shortest time a tick can take in the browser, in milliseconds
+MIN_TICK_MS = 5
+
+# Registers events name that were never set read as 0
+UNSET_REGISTER = re.compile('_.*_')
+
+class SimulationError(ValueError):
+    pass
+
+# JavaScript arithmetic where Python would raise instead
+
+def js_div(a, b):
+    if b == 0:
+        if a == 0 or a != a:
+            return math.nan
+        return math.copysign(math.inf, a) * math.copysign(1, b)
+    return a / b
+
+def js_floor(x):
+    if x != x or x in (math.inf, -math.inf):
+        raise SimulationError("unit position is not a number")
+    return math.floor(x)
+
+def js_acos(x):
+    if x != x or x < -1 or x > 1:
+        return math.nan
+    return math.acos(x)
+
+def js_str(value):
+    if isinstance(value, str):
+        return value
+    if value is None:
+        return 'undefined'
+    if value != value:
+        return 'NaN'
+    if value in (math.inf, -math.inf):
+        return 'Infinity' if value > 0 else '-Infinity'
+    if float(value).is_integer() and abs(value) < 1e21:
+        return str(int(value))
+    return repr(float(value))
+
+_FLOAT = re.compile(r'\s*([+-]?(?:Infinity|\d+\.?\d*(?:[eE][+-]?\d+)?|\.\d+(?:[eE][+-]?\d+)?))')
+_INT = re.compile(r'\s*([+-]?\d+)')
+
+def js_parse_float(s):
+    m = _FLOAT.match(s) if isinstance(s, str) else None
+    return float(m.group(1).replace('Infinity', 'inf')) if m else math.nan
+
+def js_parse_int(s):
+    m = _INT.match(s) if isinstance(s, str) else None
+    return int(m.group(1)) if m else math.nan
+
+def js_slice(seq, start, end=None):
+    n = len(seq)
+    start = max(n + start, 0) if start < 0 else min(start, n)
+    end = n if end is None else (max(n + end, 0) if end < 0 else min(end, n))
+    return list(seq[start:end])
+
+def js_index(seq, item):
+    return seq.index(item) if item in seq else -1
+
+def js_add(a, b):
+    if isinstance(a, str) or isinstance(b, str):
+        return js_str(a) + js_str(b)
+    if a is None or b is None:
+        return math.nan
+    return a + b
+
+def dist(x1, y1, x2, y2):
+    return math.sqrt((x2 - x1) * (x2 - x1) + (y2 - y1) * (y2 - y1))
+
+def getang(x1, y1, x2, y2):
+    d = dist(x1, y1, x2, y2)
+    if x2 > x1:
+        return js_acos(js_div(y1 - y2, d))
+    return math.pi * 2 - js_acos(js_div(y1 - y2, d))
+
+def partway_to(x, y, fx, fy, d):
+    fulld = dist(x, y, fx, fy)
+    if fulld <= d:
+        return fx, fy
+    return x + js_div(fx - x, fulld) * d, y + js_div(fy - y, fulld) * d
+
+# Neighbour cell of every cell in every direction of MOVEMENTS, -1 off the field
+NEIGHBOURS = [[(x + dx) * H + y + dy if 0 <= x + dx < W and 0 <= y + dy < H else -1
+               for dx, dy in MOVEMENTS]
+              for x in range(W) for y in range(H)]
+
+CELL_X = np.repeat(np.arange(W, dtype=np.float64), H)
+CELL_Y = np.tile(np.arange(H, dtype=np.float64), W)
+
+# Directions a flood spreads to from a cell it entered going `curdir`,
+# `spread` either side of it, in the order the browser tries them
+SPREAD_DIRECTIONS = [[[(curdir + 8 + k) % 8 for k in range(-spread, spread + 1)] for spread in range(5)]
+                     for curdir in range(8)]
+
+def generate_dmap(source, passable, wall_proximity):
+    # generate_dmap() of the browser: flood the field from the cells of
+    # source below 9999, in the same order, so the (approximate) distances
+    # come out exactly the same. Distances only ever go down, so a point
+    # that would not improve its cell when queued would not when taken off
+    # the queue either, and is left out.
+    source = source.tolist()
+    wall_proximity = wall_proximity.tolist()
+    dmap = [99999.0] * N
+    points = [(c, source[c], 0) for c in range(N) if passable[c] and source[c] < 9999]
+    append = points.append
+    for c, value, curdir in points:
+        if dmap[c] > value:
+            dmap[c] = value
+            if source[c] < 9999:
+                spread = 4
+            elif wall_proximity[c] == 1:
+                spread = 1 + curdir % 2
+            else:
+                spread = curdir % 2
+            neighbours = NEIGHBOURS[c]
+            step = value + 1
+            for d in SPREAD_DIRECTIONS[curdir][spread]:
+                n = neighbours[d]
+                if n >= 0 and passable[n]:
+                    # value + 1 + 0.5 * (d % 2), rounded the same way
+                    v = step + 0.5 if d % 2 else step
+                    if dmap[n] > v:
+                        append((n, v, d))
+    return np.array(dmap)
+
+# Line of sight between cells, as los() in the browser. A pair is traced
+# from whichever end is asked about first and the answer is then kept for
+# both directions, so the cache is filled in the same order too.
+class LineOfSight:
+    def __init__(self, terrain):
+        self.terrain = terrain
+        self.known = np.zeros((N, N), dtype=np.int8)
+
+    def trace_row(self, s):
+        # Trace from cell s to every cell at once, stepping like the browser
+        x1, y1 = divmod(s, H)
+        dx = CELL_X - x1
+        dy = CELL_Y - y1
+        steps = np.floor(np.sqrt(dx * dx + dy * dy) * 1.5)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            xinc = dx / steps
+            yinc = dy / steps
+        k = int(steps.max()) + 1
+        xs = np.empty((k, N))
+        ys = np.empty((k, N))
+        xs[0] = x1 + 0.5
+        ys[0] = y1 + 0.5
+        xs[1:] = xinc
+        ys[1:] = yinc
+        np.add.accumulate(xs, axis=0, out=xs)
+        np.add.accumulate(ys, axis=0, out=ys)
+        inside = np.arange(k)[:, None] <= steps[None, :]
+        cx = np.nan_to_num(np.floor(xs), nan=0).astype(np.intp).clip(0, W - 1)
+        cy = np.nan_to_num(np.floor(ys), nan=0).astype(np.intp).clip(0, H - 1)
+        blocked = (self.terrain[cx, cy] == 0) & inside
+        return np.where(blocked.any(axis=0), -1, 1).astype(np.int8)
+
+    def row(self, s):
+        known = self.known[s]
+        unknown = known == 0
+        if unknown.any():
+            values = self.trace_row(s)[unknown]
+            known[unknown] = values
+            self.known[unknown, s] = values
+        return known
+
+    def pair(self, x1, y1, x2, y2):
+        if not (0 <= x1 < W and 0 <= y1 < H and 0 <= x2 < W and 0 <= y2 < H):
+            raise SimulationError("line of sight off the field")
+        s, t = x1 * H + y1, x2 * H + y2
+        if self.known[s, t] == 0:
+            steps = math.floor(dist(x1, y1, x2, y2) * 1.5)
+            xinc = js_div(x2 - x1, steps)
+            yinc = js_div(y2 - y1, steps)
+            curx, cury = x1 + 0.5, y1 + 0.5
+            value = 1
+            for _ in range(steps + 1):
+                if self.terrain[math.floor(curx), math.floor(cury)] == 0:
+                    value = -1
+                    break
+                curx += xinc
+                cury += yinc
+            self.known[s, t] = self.known[t, s] = value
+        return int(self.known[s, t])
+
+class Unit:
+    def __init__(self, battle, uclass, xcor, ycor, strict=False):
+        if uclass not in battle.classes:
+            raise SimulationError(f"unknown unit class '{uclass}'")
+        self.battle = battle
+        self.uclass = uclass
+        spec = battle.classes[uclass]
+        for name, default in CLASS_TEMPLATE.items():
+            spec.setdefault(name, default)
+            setattr(self, name, spec[name])
+        self.attack_in = 12
+        self.in_combat = 0
+        self.ang = 0
+        units = battle.units
+        self.id = units[-1].id + 1 if units else 1
+        self.selected = 0
+        self.targeted = 0
+        self.dmap = np.zeros(N)
+        self.nx = None
+        self.ny = None
+        occupied = battle.occupied
+        done = False
+        xc = js_floor(xcor)
+        yc = js_floor(ycor)
+        if strict:
+            # The browser's loop runs ranges 0 and 1 only
+            for rng in (0, 1):
+                for i in range(xc - rng, xc + rng + 1):
+                    for j in range(yc - rng, yc + rng + 1):
+                        if 0 <= i < W and 0 <= j < H and occupied[i * H + j] == 0:
+                            battle.los.pair(xc, yc, i, j)
+                            self.setpos(i + 0.5, j + 0.5)
+                            done = True
+                            break
+                    if done:
+                        break
+                if done:
+                    break
+        if not done:
+            self.setpos(xcor, ycor)
+
+    def setpos(self, x, y):
+        floorx = js_floor(x)
+        floory = js_floor(y)
+        if not (0 <= floorx < W and 0 <= floory < H):
+            raise SimulationError("unit placed off the field")
+        self.x = x
+        self.y = y
+        if self.nx != floorx or self.ny != floory:
+            occupied = self.battle.occupied
+            if self.nx and self.ny:
+                occupied[self.nx * H + self.ny] = 0
+            self.nx = floorx
+            self.ny = floory
+            occupied[floorx * H + floory] = self.id
+            self.battle.grid.move(self, floorx, floory)
+            self.update_losmap()
+
+    @property
+    def cell(self):
+        return self.nx * H + self.ny
+
+    def update_losmap(self):
+        s = self.cell
+        x1, y1 = self.nx, self.ny
+        d = np.sqrt((CELL_X - x1) * (CELL_X - x1) + (CELL_Y - y1) * (CELL_Y - y1))
+        self.losmap = np.where(self.battle.los.row(s) == 1, d, 9999.0)
+
+    def ai(self):
+        battle = self.battle
+        final = (self.dmap + 1) - (battle.occupied == 0)
+        final[battle.threat_map[self.side] > 0] += 0.5
+        final[self.cell] -= 1
+        if self.aitype == 1 and final[self.cell] < 1:
+            opportunity = battle.opportunity_map[self.side]
+            for i in range(max(self.nx - 1, 0), min(self.nx + 1, W)):
+                for j in range(max(self.ny - 1, 0), min(self.ny + 1, H)):
+                    if opportunity[i * H + j] < self.range:
+                        final[i * H + j] = -3
+        self.move(final)
+
+    def move(self, dmap):
+        occupied = self.battle.occupied
+        nx, ny = self.nx, self.ny
+        options = [(0, 0)]
+        if ny > 0:
+            options.append((0, -1))
+        if ny < H - 1:
+            options.append((0, 1))
+        if nx > 0:
+            options.append((-1, 0))
+            if ny > 0:
+                options.append((-1, -1))
+            if ny < H - 1:
+                options.append((-1, 1))
+        if nx < W - 1:
+            options.append((1, 0))
+            if ny > 0:
+                options.append((1, -1))
+            if ny < H - 1:
+                options.append((1, 1))
+        here = dmap[nx * H + ny]
+        best = 0
+        best_score = 0
+        for i, (ox, oy) in enumerate(options):
+            mult = 0.75 if ox * oy != 0 else 1
+            score = (dmap[(nx + ox) * H + ny + oy] - here) * mult
+            if score < best_score:
+                best_score = score
+                best = i
+        ox, oy = options[best]
+        v = self.speed * self.cmult if self.in_combat else self.speed
+        # Backward movement penalty
+        if ox != 0 or oy != 0:
+            ang = getang(0, 0, ox, oy)
+            dif = abs(self.ang - ang)
+            if dif > math.pi:
+                dif = 2 * math.pi - dif
+            v *= (1 - (1 - self.bmult) * dif / math.pi)
+        destx, desty = partway_to(self.x, self.y, nx + 0.5 + ox, ny + 0.5 + oy, v)
+        fmapx = js_floor(destx)
+        fmapy = js_floor(desty)
+        if (fmapx != nx or fmapy != ny) and (fmapx < 0 or fmapy < 0 or fmapx >= W or fmapy >= H
+                                             or occupied[fmapx * H + fmapy] != 0):
+            if 0 <= fmapy < H and (occupied[nx * H + fmapy] == 0 or fmapy == ny):
+                destx = self.x
+            elif 0 <= fmapx < W and (occupied[fmapx * H + ny] == 0 or fmapx == nx):
+                desty = self.y
+            else:
+                destx = self.x
+                desty = self.y
+        # Turn towards where we are going, 5 degrees per tick
+        if destx != self.x or desty != self.y:
+            target_ang = getang(self.x, self.y, destx, desty)
+            if abs(self.ang - target_ang) < 0.0725 or abs(self.ang - target_ang) > 6.2106:
+                self.ang = target_ang
+            elif self.ang > target_ang and self.ang - target_ang < math.pi or self.ang < target_ang - math.pi:
+                self.ang -= 0.0725
+            else:
+                self.ang += 0.0725
+        self.setpos(destx, desty)
+
+    def getvictim(self):
+        # The enemy worth attacking most and the damage dealt to every unit
+        # hit, comparing units as if they stood in the centres of their cells
+        battle = self.battle
+        units = battle.units
+        occupied = battle.occupied
+        terrain = battle.terrain
+        losmap = self.losmap
+        nx, ny = self.nx, self.ny
+        best_priority = 0
+        best_unit = -1
+        best_target_dmg = {}
+        # Only units in range can be attacked, and a unit in range is at
+        # most `range` away; candidates go in unit order like in the browser,
+        # since the first of equally good targets wins
+        candidates = []
+        for target in battle.grid.near(nx, ny, self.range):
+            if target.side != self.side and losmap[target.cell] < self.range:
+                candidates.append(target)
+        candidates.sort(key=lambda u: u.id)
+        for target in candidates:
+            i = battle.id_lookup[target.id]
+            tx, ty = target.nx, target.ny
+            d = float(losmap[target.cell])
+            inacc = min(math.floor(d * 0.5), self.inacc)
+            priority = 0
+            target_dmg = {}
+            j = 0 - inacc
+            while j <= inacc:
+                destx, desty = partway_to(tx + 0.5, ty + 0.5, nx + 0.5, ny + 0.5, j)
+                dx = js_floor(destx)
+                dy = js_floor(desty)
+                if 0 <= dx < W and 0 <= dy < H and losmap[dx * H + dy] < self.range and occupied[dx * H + dy] > 0:
+                    v = battle.id_lookup[int(occupied[dx * H + dy])]
+                    victim = units[v]
+                    slopedif = terrain[nx, ny] - terrain[dx, dy]
+                    higher = 1 if slopedif > 0 else -1
+                    slopemult = 1 + math.sqrt(abs(slopedif) / (d + 1)) * 0.1 * higher
+                    angdif = abs(getang(dx, dy, nx, ny) - victim.ang)
+                    if angdif > math.pi:
+                        angdif = 2 * math.pi - angdif
+                    angmult = 1 + (angdif - math.pi * 0.5) * 2 / (d + 1) / math.pi
+                    inaccmult = (inacc + 1 - abs(j)) / ((inacc + 1) * (inacc + 1))
+                    dmg = self.damage * slopemult * angmult * inaccmult
+                    dist_addition = self.damage * 0.013 / (max(d - target.range, 0) + 2)
+                    p = js_div(dmg, victim.health * 0.6 + battle.classes[victim.uclass]['health'] * 0.4 + 0.01) + dist_addition
+                    if victim.side == self.side:
+                        p *= -1.5
+                    if self.aitype > 0 and target.targeted == 1:
+                        p = p * 3 + 0.1
+                    if self.aitype > 0 and target.targeted == 2:
+                        p = p * 9 + 0.4
+                    if self.aitype > 0 and target.targeted == 3:
+                        p = p * 27 + 0.9
+                    priority += p
+                    target_dmg[v] = dmg
+                j += 1
+            if priority > best_priority:
+                best_priority = priority
+                best_unit = i
+                best_target_dmg = target_dmg
+        return best_unit, best_target_dmg
+
+# Result of a replay, in the terms of the score a client submits
+class Outcome:
+    def __init__(self, win, friendly_losses, enemy_losses, time, ticks):
+        self.win = win
+        self.friendly_losses = friendly_losses
+        self.enemy_losses = enemy_losses
+        self.time = time
+        self.ticks = ticks
+
+    def score(self):
+        return [self.win, self.friendly_losses, self.enemy_losses, self.time]
+
+    def __repr__(self):
+        return f"Outcome(win={self.win}, friendly_losses={self.friendly_losses}, enemy_losses={self.enemy_losses}, time={self.time}, ticks={self.ticks})"
+
+class Battle:
+    def __init__(self, level, start_time=-1):
+        parsed = parse_level(level) if isinstance(level, str) else level
+        if parsed.width != W or parsed.height != H:
+            raise SimulationError(f"terrain must be {W}x{H}")
+        self.terrain = np.array(list(parsed.terrain), dtype=np.float64).reshape(W, H)
+        self.passable = (self.terrain > 0).ravel().tolist()
+        # Distance to the nearest wall, flooded over an open field
+        walls = np.where(self.terrain.ravel() > 0, 99999.0, 0.0)
+        self.wall_proximity = generate_dmap(walls, [True] * N, walls)
+        self.los = LineOfSight(self.terrain)
+        self.classes = json.loads(json.dumps(parsed.classes))
+        self.events = [list(e) for e in parsed.events]
+        self.registers = {}
+        self.setup = []
+        self.units = []
+        # Where every unit is, for finding the ones in range quickly
+        self.grid = SpatialGrid(W, H)
+        self.occupied = np.zeros(N, dtype=np.int64)
+        self.point_dmaps = {}
+        # Distance maps by source. The enemies' reach changes only when they
+        # step into another cell, so most ticks flood the same sources again.
+        self.dmaps = RenderCache(16 * N * 8, sizeof=lambda dmap: dmap.nbytes)
+        self.opportunity_map = {}
+        self.threat_map = {}
+        self.id_lookup = {}
+        self.forcewin = 0
+        self.friendly_losses = 0
+        self.enemy_losses = 0
+        self.time = start_time if parsed.story else 0
+        self.ticks = 0
+        self.result = None
+        self.check_events()
+
+    # Events
+
+    def check_conds(self, conds):
+        ul = list(self.units)
+        for c in conds:
+            if c != "onetime" and c != "none":
+                if c[:1] == "$":
+                    ul = [u for u in ul if u.desc == c[1:]]
+                elif c[:2] == "l$":
+                    checked = [u for u in ul if u.desc == c[2:]]
+                    ul = [u for u in ul if any(self.los.pair(u.nx, u.ny, k.nx, k.ny) == 1 for k in checked)]
+                else:
+                    mark = 0
+                    for j, ch in enumerate(c):
+                        if ch in "abcdefghijklmnopqrstuvwxyz=<>":
+                            mark = j
+                            break
+                    left = js_parse_int(c[:mark])
+                    right = js_parse_int(c[mark + 1:])
+                    op = c[mark:mark + 1]
+                    t = self.time
+                    if op == "t":
+                        if mark == len(c) - 1 and t != left:
+                            return []
+                        if mark < len(c) - 1 and math.fmod(t - left, right) != 0 or t < left:
+                            return []
+                    elif op == "=":
+                        if left != right:
+                            return []
+                    elif op == ">":
+                        if left <= right:
+                            return []
+                    elif op == "<":
+                        if left >= right:
+                            return []
+                    elif op == "s":
+                        ul = [u for u in ul if u.side == right]
+                    elif op == "x":
+                        ul = [u for u in ul if not (u.x < left or u.x > right)]
+                    elif op == "y":
+                        ul = [u for u in ul if not (u.y < left or u.y > right)]
+                    elif op == "h":
+                        ul = [u for u in ul if not (u.health < left or u.health > right)]
+                    elif op == "l":
+                        ul = [u for u in ul if self.los.pair(u.nx, u.ny, left, right) >= 1]
+            if not ul:
+                return []
+        return ul
+
+    def check_events(self):
+        events = self.events
+        i = 0
+        while i < len(events):
+            e = list(events[i])
+            for r, value in self.registers.items():
+                pattern = re.compile('_' + r + '_')
+                e = [pattern.sub(lambda m: js_str(value), s) for s in e]
+            e = [UNSET_REGISTER.sub('0', s) if '_' in s else s for s in e]
+            kind = e[0] if e else None
+            if kind in ("unit", "xunit"):
+                self.units.append(Unit(self, e[1] if len(e) > 1 else None,
+                                       js_parse_float(e[2] if len(e) > 2 else None),
+                                       js_parse_float(e[3] if len(e) > 3 else None), kind == "xunit"))
+                del events[i]
+            elif kind == "win":
+                self.forcewin = 1
+                break
+            elif kind == "lose":
+                self.forcewin = -1
+                break
+            elif kind in ("when", "whenever") and self.time > 0:
+                do = js_index(e, "do")
+                conds = js_slice(e, 1, do)
+                u = self.check_conds(conds)
+                if (len(u) > 0) if "none" not in conds else (len(u) == 0):
+                    events.insert(i + 1, js_slice(e, do + 1))
+                    if kind == "when":
+                        del events[i]
+                    else:
+                        i += 1
+                else:
+                    i += 1
+            elif kind in ("set", "change"):
+                ind = js_index(e, "attribute")
+                u = self.check_conds(js_slice(e, 1, ind))
+                name = e[ind + 1] if 0 <= ind + 1 < len(e) else None
+                raw = e[ind + 2] if 0 <= ind + 2 < len(e) else None
+                value = raw if name in ("desc", "image") else js_parse_float(raw)
+                for unit in u:
+                    if kind == "set":
+                        setattr(unit, name, value)
+                    else:
+                        setattr(unit, name, js_add(getattr(unit, name, None), value))
+                del events[i]
+            elif kind == "setr":
+                self.registers[e[1]] = e[2]
+                del events[i]
+            elif kind == "changer":
+                self.registers[e[1]] = js_add(self.registers.get(e[1]), js_parse_float(e[2]))
+                del events[i]
+            elif kind == "setup":
+                self.setup += [js_parse_float(v) for v in e[1:5]]
+                del events[i]
+            else:
+                i += 1
+
+    # Player commands
+
+    def flood(self, source):
+        key = source.tobytes()
+        dmap = self.dmaps.get(key)
+        if dmap is None:
+            dmap = self.dmaps.put(key, generate_dmap(source, self.passable, self.wall_proximity))
+        # Callers adjust their map in place
+        return dmap.copy()
+
+    def point_dmap(self, x, y):
+        x = min(max(x, 0), W - 1)
+        y = min(max(y, 0), H - 1)
+        dmap = self.point_dmaps.get((x, y))
+        if dmap is None:
+            source = np.full(N, 99999.0)
+            source[x * H + y] = 0
+            dmap = self.point_dmaps[(x, y)] = generate_dmap(source, self.passable, self.wall_proximity)
+        return dmap.copy()
+
+    def send_targets(self, mx, my, in_formation=0):
+        chosen = [u for u in self.units if u.selected == 1 and u.aitype > 0]
+        if in_formation == 1:
+            if chosen:
+                dx = mx - math.floor(sum(u.x for u in chosen) / len(chosen))
+                dy = my - math.floor(sum(u.y for u in chosen) / len(chosen))
+        else:
+            dmap = self.point_dmap(mx, my)
+        for u in chosen:
+            if in_formation == 1:
+                dfx = js_floor(u.x + dx)
+                dfy = js_floor(u.y + dy)
+            else:
+                dfx, dfy = mx, my
+            if u.aitype == 4:
+                u.aitype = 1
+            if in_formation == 0 and u.aitype == 1 and u.side == 1:
+                u.dmap = dmap
+            else:
+                u.dmap = self.point_dmap(dfx, dfy)
+            # Placing units inside the setup rectangles before the battle
+            if self.time == 0:
+                setup = self.setup
+                inside = False
+                for j in range(0, len(setup) - 3, 4):
+                    if ((dfx + 0.5 - setup[j]) * (dfx + 0.5 - setup[j + 2]) < 0
+                            and (dfy + 0.5 - setup[j + 1]) * (dfy + 0.5 - setup[j + 3]) < 0
+                            and 0 <= dfx < W and 0 <= dfy < H and self.occupied[dfx * H + dfy] == 0):
+                        inside = True
+                if inside:
+                    u.setpos(dfx + 0.5, dfy + 0.5)
+                    u.selected = 0
+                    if in_formation == 0:
+                        break
+
+    def command(self, name, *args):
+        if name == 'select':
+            ids = set(args[0])
+            for u in self.units:
+                u.selected = 1 if u.id in ids else 0
+        elif name == 'send':
+            self.send_targets(int(args[0]), int(args[1]), int(args[2]) if len(args) > 2 else 0)
+        elif name == 'mode':
+            for u in self.units:
+                if u.selected == 1 and u.aitype > 0:
+                    u.aitype = int(args[0])
+        elif name == 'target':
+            for u in self.units:
+                if u.selected:
+                    if args[0] > 0 and u.targeted < 3:
+                        u.targeted += 1
+                    elif args[0] < 0 and u.targeted > 0:
+                        u.targeted -= 1
+        elif name == 'skip':
+            if self.time <= 0:
+                self.time = 1
+        else:
+            raise SimulationError(f"unknown command '{name}'")
+
+    # The game loop
+
+    def side_maps(self, side, others):
+        # Cells enemies can attack from (the range they need) and the damage
+        # idle enemies would deal to a unit of this side in every cell
+        omap = np.full(N, 9999.0)
+        tmap = np.zeros(N)
+        for u in others:
+            np.minimum(omap, u.losmap, out=omap)
+            if u.in_combat == 0:
+                tmap += np.where(u.losmap < u.range, u.damage, 0)
+        return omap, tmap
+
+    def update(self):
+        self.ticks += 1
+        self.check_events()
+        units = self.units
+        friendly = sum(1 for u in units if u.side == 1)
+        enemy = len(units) - friendly
+        if (friendly == 0 and self.forcewin < 1) or self.forcewin == -1:
+            self.result = Outcome(0, self.friendly_losses, self.enemy_losses, self.time, self.ticks)
+        elif enemy == 0 or self.forcewin == 1:
+            self.result = Outcome(1, self.friendly_losses, self.enemy_losses, self.time, self.ticks)
+
+        self.id_lookup = {u.id: i for i, u in enumerate(units)}
+        occupied = np.where(self.terrain.ravel() > 0, 0, -1).astype(np.int64)
+        for u in units:
+            occupied[u.cell] = u.id
+        self.occupied = occupied
+
+        sides = []
+        for u in units:
+            if u.side not in sides:
+                sides.append(u.side)
+        for side in sides:
+            omap, tmap = self.side_maps(side, [u for u in units if u.side != side])
+            self.opportunity_map[side] = omap
+            self.threat_map[side] = tmap
+
+        # Distance maps of computer controlled units, shared by units of the
+        # same class and mode
+        for i, u in enumerate(units):
+            if (u.aitype == 0 or u.aitype == 4) and u.speed > 0:
+                for j in range(i - 1, -1, -1):
+                    if u.uclass == units[j].uclass and u.aitype == units[j].aitype:
+                        u.dmap = units[j].dmap
+                        break
+                else:
+                    om = np.where(self.opportunity_map[u.side] < u.range, 0.0, 99999.0)
+                    threat = self.threat_map[u.side]
+                    tm = np.full(N, 99999.0)
+                    for c in np.flatnonzero(threat > 0).tolist():
+                        tm[c] = -0.693 * math.log(threat[c])
+                    dm = self.flood(om)
+                    tm = self.flood(tm)
+                    near = tm < 9999
+                    dm[near] -= tm[near] * 0.33
+                    u.dmap = dm
+
+        for u in units:
+            if u.speed > 0:
+                u.ai()
+
+        for u in units:
+            if u.aitype != 3 and u.damage > 0:
+                u.attack_in -= 1
+            if u.attack_in < 0 and u.aitype != 3 and u.damage > 0:
+                victim, damage = u.getvictim()
+                if victim >= 0:
+                    u.attack_in = 10
+                    for j, dmg in damage.items():
+                        units[j].health -= dmg
+                    u.ang = getang(u.nx, u.ny, units[victim].nx, units[victim].ny)
+                    u.in_combat = 1
+                else:
+                    u.in_combat = 0
+
+        alive = []
+        for u in units:
+            if u.health <= 0:
+                self.grid.remove(u)
+                if u.side == 1:
+                    self.friendly_losses += 1
+                else:
+                    self.enemy_losses += 1
+            else:
+                alive.append(u)
+        self.units = alive
+        self.time += 1
+
+    def run(self, inputs=(), max_ticks=20000):
+        # Play until the game is won or lost, or give up after max_ticks
+        inputs = sorted(inputs, key=lambda entry: entry[0])
+        k = 0
+        while self.result is None and self.ticks < max_ticks:
+            while k < len(inputs) and inputs[k][0] <= self.time:
+                self.command(*inputs[k][1:])
+                k += 1
+            self.update()
+        return self.result
+
+def replay(level, inputs=(), start_time=-1, max_ticks=20000):
+    return Battle(level, start_time).run(inputs, max_ticks)
+
+def verify(level, score, inputs=(), max_ticks=20000):
+    # Whether a submitted score [win, friendly_losses, enemy_losses, time,
+    # realtime] is what replaying the inputs gives. The game starts at time
+    # -1 after a story and at 0 when retrying, so both are tried.
+    win, friendly_losses, enemy_losses, time = [int(v) for v in score[:4]]
+    for start_time in (-1, 0):
+        try:
+            outcome = replay(level, inputs, start_time, max_ticks)
+        except SimulationError:
+            return False
+        if outcome is None:
+            continue
+        if outcome.score() == [win, friendly_losses, enemy_losses, time]:
+            # Every tick takes at least MIN_TICK_MS of real time
+            return len(score) < 5 or int(score[4]) >= MIN_TICK_MS * outcome.ticks
+    return False
+
+def _verify_job(job):
+    return verify(*job)
+
+def verify_many(jobs, processes=None):
+    # Verify many (level, score, inputs) jobs over a process pool
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        return list(pool.map(_verify_job, jobs, chunksize=4))
+
+def load_level(path, number):
+    # Level `number` (counting from 1) of a campaign file
+    with open(path) as file:
+        _, texts = read_campaign(file)
+        for n, text in enumerate(texts, 1):
+            if n == number:
+                return text
+    raise SimulationError(f"{path} has no level {number}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay a level headlessly and print the outcome')
+    parser.add_argument('campaign', help='campaign file, e.g. data/tutorial.txt')
+    parser.add_argument('level', type=int, help='level number, counting from 1')
+    parser.add_argument('--inputs', help='JSON file with the input log')
+    parser.add_argument('--start-time', type=int, default=-1)
+    parser.add_argument('--max-ticks', type=int, default=20000)
+    args = parser.parse_args()
+    inputs = []
+    if args.inputs:
+        with open(args.inputs) as file:
+            inputs = json.load(file)
+    outcome = replay(load_level(args.campaign, args.level), inputs, args.start_time, args.max_ticks)
+    print(outcome if outcome is not None else f"no result after {args.max_ticks} ticks")
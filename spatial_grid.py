@@ -0,0 +1,59 @@
+import math
+
+# Objects on the battle field bucketed by position, so the ones within some
+# distance of a point are found by looking at a few buckets instead of at
+# every object. Positions are updated in place as objects move (move() is
+# cheap when an object stays in its bucket), so the index never has to be
+# rebuilt between ticks. Objects must be hashable.
+class SpatialGrid:
+    def __init__(self, width, height, bucket_size=4):
+        self.bucket_size = bucket_size
+        self.cols = -(-width // bucket_size)
+        self.rows = -(-height // bucket_size)
+        self.buckets = [{} for _ in range(self.cols * self.rows)]
+        self.where = {}
+
+    def _bucket(self, x, y):
+        bx = min(max(int(x // self.bucket_size), 0), self.cols - 1)
+        by = min(max(int(y // self.bucket_size), 0), self.rows - 1)
+        return bx * self.rows + by
+
+    def move(self, item, x, y):
+        # Insert an object, or record its new position
+        b = self._bucket(x, y)
+        old = self.where.get(item)
+        if old is not None and old[0] != b:
+            del self.buckets[old[0]][item]
+        self.buckets[b][item] = (x, y)
+        self.where[item] = (b, x, y)
+
+    def remove(self, item):
+        old = self.where.pop(item, None)
+        if old is not None:
+            del self.buckets[old[0]][item]
+
+    def near(self, x, y, radius):
+        # Objects closer than `radius` to (x, y), in no particular order
+        found = []
+        if not radius > 0:
+            return found
+        size = self.bucket_size
+        # Nothing on the field is further away than this, which also keeps
+        # an infinite radius usable
+        reach = min(radius, (self.cols + self.rows) * size + abs(x) + abs(y))
+        x0 = max(math.floor((x - reach) / size), 0)
+        x1 = min(math.floor((x + reach) / size), self.cols - 1)
+        y0 = max(math.floor((y - reach) / size), 0)
+        y1 = min(math.floor((y + reach) / size), self.rows - 1)
+        for bx in range(x0, x1 + 1):
+            for b in range(bx * self.rows + y0, bx * self.rows + y1 + 1):
+                for item, (ix, iy) in self.buckets[b].items():
+                    if math.sqrt((ix - x) * (ix - x) + (iy - y) * (iy - y)) < radius:
+                        found.append(item)
+        return found
+
+    def __len__(self):
+        return len(self.where)
+
+    def __contains__(self, item):
+        return item in self.where
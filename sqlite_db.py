@@ -0,0 +1,427 @@
+import os
+import weakref
+import sqlite3
+import threading
+import contextlib
+import datetime
+from collections import Counter
+from level_format import split_sections, chunk_key
+
+# Tables and indexes. levels is indexed on (campaign, counter) like
+# index.yaml; the index is not unique so that shifting a campaign can be a
+# single range UPDATE, and save() keeps one level per slot itself. Level
+# text is kept in chunks, one row per distinct section shared by every
+# level that has it: levels.chunks lists a level's chunk hashes in order
+# and chunks.refs counts the levels using each. Rows written before chunks
+# existed keep their text in levels.text until they are saved again.
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS savedata (
+    id INTEGER PRIMARY KEY,
+    player TEXT, nick TEXT, campaign TEXT, counter INTEGER
+);
+CREATE UNIQUE INDEX IF NOT EXISTS savedata_player_campaign ON savedata (player, campaign);
+CREATE INDEX IF NOT EXISTS savedata_campaign ON savedata (campaign, counter);
+
+CREATE TABLE IF NOT EXISTS results (
+    id INTEGER PRIMARY KEY,
+    player TEXT, nick TEXT, campaign TEXT, counter INTEGER, win INTEGER,
+    friendly_losses INTEGER, enemy_losses INTEGER, time INTEGER, realtime INTEGER,
+    worldtime TEXT
+);
+CREATE INDEX IF NOT EXISTS results_campaign_counter_win ON results (campaign, counter, win);
+
+CREATE TABLE IF NOT EXISTS levels (
+    id INTEGER PRIMARY KEY,
+    campaign TEXT, counter INTEGER, text TEXT, owner TEXT, nick TEXT, date TEXT, chunks TEXT
+);
+CREATE INDEX IF NOT EXISTS levels_campaign_counter ON levels (campaign, counter);
+
+CREATE TABLE IF NOT EXISTS chunks (
+    hash TEXT PRIMARY KEY,
+    text TEXT, refs INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS campaigns (
+    campaign TEXT PRIMARY KEY,
+    levels INTEGER, owner TEXT, nick TEXT, modified TEXT, version INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS seeds (
+    path TEXT PRIMARY KEY,
+    stamp TEXT, hash TEXT, campaign TEXT
+);
+'''
+
+# Types stored as they are; anything else (such as the property placeholder
+# of a field that was never set) is stored as NULL
+STORED_TYPES = (str, int, float, bytes, datetime.datetime, type(None))
+
+# Model kind -> (table, columns, columns holding datetimes)
+TABLES = {
+    'Savedata': ('savedata', ('player', 'nick', 'campaign', 'counter'), ()),
+    'Result': ('results', ('player', 'nick', 'campaign', 'counter', 'win', 'friendly_losses',
+                           'enemy_losses', 'time', 'realtime', 'worldtime'), ('worldtime',)),
+    'Level': ('levels', ('campaign', 'counter', 'text', 'owner', 'nick', 'date'), ('date',)),
+}
+LEVEL_COLUMNS = TABLES['Level'][1] + ('chunks',)
+
+# A thread's connection. The thread-local slot holds the only strong
+# reference, so the connection is closed when its thread ends; the
+# dev server runs every request on a thread of its own. Only the process
+# that opened it closes it: a forked child must not touch the parent's.
+class ThreadConnection:
+    def __init__(self, conn):
+        self.conn = conn
+        self.pid = os.getpid()
+        weakref.finalize(self, close_connection, conn, self.pid)
+
+def close_connection(conn, pid):
+    if os.getpid() == pid:
+        conn.close()
+
+# Storage backend with the same surface as app.MemoryDB on top of SQLite.
+# Every thread gets its own connection, the database runs in WAL mode so
+# readers never wait on the writer, and an entity's row id is kept in its
+# `key`, as ndb would. Several processes may open the same file.
+class SQLiteDB:
+    shared = True
+    
+    def __init__(self, path):
+        self.path = path
+        self.models = {}
+        self.local = threading.local()
+        self.connections = weakref.WeakSet()
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        conn = self.connection()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.executescript(SCHEMA)
+        if 'chunks' not in [row['name'] for row in conn.execute('PRAGMA table_info(levels)')]:
+            conn.execute('ALTER TABLE levels ADD COLUMN chunks TEXT')
+
+    def register(self, *model_classes):
+        for model_class in model_classes:
+            self.models[model_class.__name__] = model_class
+
+    def connection(self):
+        # Connections must not cross a fork, so a forked worker (gunicorn
+        # with preload_app) leaves the ones it inherited alone, without
+        # using or closing them, and opens its own
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.local = threading.local()
+            self.connections = weakref.WeakSet()
+        holder = getattr(self.local, 'conn', None)
+        if holder is None:
+            conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False,
+                                   cached_statements=256, timeout=30)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.row_factory = sqlite3.Row
+            holder = ThreadConnection(conn)
+            self.local.conn = holder
+            self.local.depth = 0
+            with self.lock:
+                self.connections.add(holder)
+        return holder.conn
+
+    def close(self):
+        with self.lock:
+            for holder in list(self.connections):
+                close_connection(holder.conn, holder.pid)
+            self.connections = weakref.WeakSet()
+        self.local = threading.local()
+
+    @contextlib.contextmanager
+    def transaction(self, write=True):
+        # Nested transactions join the outermost one, which commits once.
+        # Read-only ones take no lock and only make several reads see the
+        # same state of the database.
+        conn = self.connection()
+        if self.local.depth:
+            self.local.depth += 1
+            try:
+                yield self
+            finally:
+                self.local.depth -= 1
+            return
+        conn.execute('BEGIN IMMEDIATE' if write else 'BEGIN')
+        self.local.depth = 1
+        try:
+            yield self
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        else:
+            conn.execute('COMMIT')
+        finally:
+            self.local.depth = 0
+
+    def execute(self, sql, params=()):
+        return self.connection().execute(sql, params)
+
+    # Rows and entities
+
+    def _entity(self, model_class, row):
+        _, columns, datetimes = TABLES[model_class.__name__]
+        values = {c: row[c] for c in columns}
+        for c in datetimes:
+            if values[c] is not None:
+                values[c] = datetime.datetime.fromisoformat(values[c])
+        entity = model_class(**values)
+        entity.key = row['id']
+        return entity
+
+    def _values(self, item):
+        _, columns, datetimes = TABLES[item.__class__.__name__]
+        values = []
+        for c in columns:
+            value = getattr(item, c, None)
+            if not isinstance(value, STORED_TYPES):
+                value = None
+            if c in datetimes and value is not None:
+                value = str(value)
+            values.append(value)
+        return values
+
+    def query(self, model_class, **filters):
+        kind = model_class.__name__
+        if kind not in TABLES:
+            return []
+        table, columns, _ = TABLES[kind]
+        # Filtering on an attribute the model does not have matches nothing
+        if any(k not in columns for k in filters):
+            return []
+        sql = f'SELECT * FROM {table}'
+        if filters:
+            sql += ' WHERE ' + ' AND '.join(f'{k} = ?' for k in filters)
+        sql += ' ORDER BY campaign, counter' if kind == 'Level' else ' ORDER BY id'
+        if kind == 'Level':
+            with self.transaction(write=False):
+                return self._levels(self.execute(sql, tuple(filters.values())).fetchall())
+        rows = self.execute(sql, tuple(filters.values())).fetchall()
+        return [self._entity(model_class, row) for row in rows]
+
+    def save(self, item):
+        kind = item.__class__.__name__
+        if kind not in TABLES:
+            return item
+        table, columns, _ = TABLES[kind]
+        values = self._values(item)
+        with self.transaction():
+            if kind == 'Savedata':
+                # One save per (player, campaign)
+                row = self.execute(
+                    'INSERT INTO savedata (player, nick, campaign, counter) VALUES (?, ?, ?, ?) '
+                    'ON CONFLICT (player, campaign) DO UPDATE SET nick = excluded.nick, counter = excluded.counter '
+                    'RETURNING id', values).fetchone()
+                item.key = row[0]
+            elif kind == 'Level':
+                # One level per (campaign, counter)
+                self._check_counter(item)
+                old_campaign = None
+                if item.key is not None:
+                    row = self.execute('SELECT campaign FROM levels WHERE id = ?', (item.key,)).fetchone()
+                    old_campaign = row[0] if row else None
+                slot = ('campaign = ? AND counter = ? AND id IS NOT ?', (item.campaign, item.counter, item.key))
+                self._release_chunks(*slot)
+                self.execute('DELETE FROM levels WHERE ' + slot[0], slot[1])
+                self._write_level(item)
+                if old_campaign is not None and old_campaign != item.campaign:
+                    self._touch(old_campaign)
+                self._touch(item.campaign)
+            else:
+                self._write_row(table, columns, values, item)
+        return item
+
+    def _write_row(self, table, columns, values, item):
+        if item.key is not None:
+            cursor = self.execute(
+                f'UPDATE {table} SET ' + ', '.join(f'{c} = ?' for c in columns) + ' WHERE id = ?',
+                values + [item.key])
+            if cursor.rowcount:
+                return
+        names = ', '.join(columns)
+        marks = ', '.join('?' for _ in columns)
+        item.key = self.execute(f'INSERT INTO {table} ({names}) VALUES ({marks})', values).lastrowid
+
+    def put_multi(self, items):
+        with self.transaction():
+            return [self.save(item) for item in items]
+
+    def delete(self, item):
+        kind = item.__class__.__name__
+        if kind not in TABLES or item.key is None:
+            return
+        table = TABLES[kind][0]
+        with self.transaction():
+            if kind == 'Level':
+                self._release_chunks('id = ?', (item.key,))
+            self.execute(f'DELETE FROM {table} WHERE id = ?', (item.key,))
+            if kind == 'Level':
+                self._touch(item.campaign)
+        item.key = None
+
+    # Level text
+
+    def _write_level(self, level):
+        # Store the level's sections first, so sections the old version
+        # shares with the new one are never dropped in between
+        values = self._values(level)
+        values[LEVEL_COLUMNS.index('text')] = None
+        keys = self._add_chunks(level.text)
+        if level.key is not None:
+            self._release_chunks('id = ?', (level.key,))
+        self._write_row('levels', LEVEL_COLUMNS, values + [keys], level)
+
+    def _add_chunks(self, text):
+        keys = []
+        for piece in split_sections(text or ''):
+            key = chunk_key(piece)
+            self.execute('INSERT INTO chunks (hash, text, refs) VALUES (?, ?, 1) '
+                         'ON CONFLICT (hash) DO UPDATE SET refs = refs + 1', (key, piece))
+            keys.append(key)
+        return ' '.join(keys)
+
+    def _release_chunks(self, where, params):
+        # Drop the references of the level rows matching `where`, deleting
+        # the chunks no level uses any more
+        counts = Counter()
+        for row in self.execute(f'SELECT chunks FROM levels WHERE {where}', params).fetchall():
+            counts.update((row[0] or '').split())
+        for key, n in counts.items():
+            self.execute('UPDATE chunks SET refs = refs - ? WHERE hash = ?', (n, key))
+            self.execute('DELETE FROM chunks WHERE hash = ? AND refs <= 0', (key,))
+
+    def _levels(self, rows):
+        # Level entities with their text put back together, fetching every
+        # chunk they need at once
+        keys = list({key for row in rows for key in (row['chunks'] or '').split()})
+        pieces = {}
+        for i in range(0, len(keys), 500):
+            batch = keys[i:i + 500]
+            marks = ', '.join('?' for _ in batch)
+            for row in self.execute(f'SELECT hash, text FROM chunks WHERE hash IN ({marks})', batch):
+                pieces[row[0]] = row[1]
+        levels = []
+        for row in rows:
+            level = self._entity(self.models['Level'], row)
+            if row['chunks'] is not None:
+                level.text = ''.join([pieces[key] for key in row['chunks'].split()])
+            levels.append(level)
+        return levels
+
+    def chunk_stats(self):
+        row = self.execute('SELECT COUNT(*), SUM(LENGTH(text)), SUM(refs) FROM chunks').fetchone()
+        return {'chunks': row[0], 'bytes': row[1] or 0, 'refs': row[2] or 0}
+
+    # Campaigns
+
+    def _touch(self, campaign):
+        # Refresh the catalog entry and bump the version of a campaign; the
+        # row stays when the campaign empties so versions never repeat
+        first = self.execute(
+            'SELECT owner, nick FROM levels WHERE campaign = ? ORDER BY counter LIMIT 1',
+            (campaign,)).fetchone()
+        count = self.execute('SELECT MAX(counter) FROM levels WHERE campaign = ?', (campaign,)).fetchone()[0]
+        self.execute(
+            'INSERT INTO campaigns (campaign, levels, owner, nick, modified, version) VALUES (?, ?, ?, ?, ?, 1) '
+            'ON CONFLICT (campaign) DO UPDATE SET levels = excluded.levels, owner = excluded.owner, '
+            'nick = excluded.nick, modified = excluded.modified, version = campaigns.version + 1',
+            (campaign, count or 0, first[0] if first else None, first[1] if first else None,
+             str(datetime.datetime.now())))
+
+    def campaign_version(self, campaign):
+        row = self.execute('SELECT version FROM campaigns WHERE campaign = ?', (campaign,)).fetchone()
+        return row[0] if row else 0
+
+    def catalog(self):
+        rows = self.execute('SELECT * FROM campaigns WHERE levels > 0 ORDER BY rowid').fetchall()
+        return {row['campaign']: {
+            'campaign': row['campaign'],
+            'levels': row['levels'],
+            'owner': row['owner'],
+            'nick': row['nick'],
+            'modified': datetime.datetime.fromisoformat(row['modified']),
+        } for row in rows}
+
+    def results_since(self, key):
+        rows = self.execute('SELECT * FROM results WHERE id > ? AND win = 1 ORDER BY id', (key,)).fetchall()
+        return [self._entity(self.models['Result'], row) for row in rows]
+
+    def progress(self, player):
+        rows = self.execute('SELECT campaign, counter FROM savedata WHERE player = ? ORDER BY id', (player,))
+        return {row['campaign']: row['counter'] for row in rows}
+
+    def _check_counter(self, level):
+        if not isinstance(level.counter, int) or level.counter < 1:
+            raise ValueError(f"level {level.counter} is outside campaign '{level.campaign}'")
+
+    def insert_level(self, level):
+        self._check_counter(level)
+        with self.transaction():
+            if level.key is not None:
+                self._release_chunks('id = ?', (level.key,))
+                self.execute('DELETE FROM levels WHERE id = ?', (level.key,))
+                level.key = None
+            self.execute('UPDATE levels SET counter = counter + 1 WHERE campaign = ? AND counter >= ?',
+                         (level.campaign, level.counter))
+            self._write_level(level)
+            self._touch(level.campaign)
+        return level
+
+    def delete_level(self, campaign, counter):
+        with self.transaction():
+            row = self.execute('SELECT * FROM levels WHERE campaign = ? AND counter = ?',
+                               (campaign, counter)).fetchone()
+            if row is None:
+                return None
+            level = self._levels([row])[0]
+            self._release_chunks('id = ?', (row['id'],))
+            self.execute('DELETE FROM levels WHERE id = ?', (row['id'],))
+            self.execute('UPDATE levels SET counter = counter - 1 WHERE campaign = ? AND counter > ?',
+                         (campaign, counter))
+            self._touch(campaign)
+        level.key = None
+        return level
+
+    def move_level(self, campaign, old, new):
+        with self.transaction():
+            level = self.delete_level(campaign, old)
+            if level is not None:
+                level.counter = new
+                self.insert_level(level)
+        return level
+
+    def save_progress(self, save):
+        # Keep the furthest save point of the player in the campaign
+        row = self.execute(
+            'INSERT INTO savedata (player, nick, campaign, counter) VALUES (?, ?, ?, ?) '
+            'ON CONFLICT (player, campaign) DO UPDATE SET nick = excluded.nick, '
+            'counter = MAX(savedata.counter, excluded.counter) RETURNING id, counter',
+            self._values(save)).fetchone()
+        save.key, save.counter = row[0], row[1]
+        return save
+
+    def shift_saves(self, campaign, start, delta, player=None):
+        where = 'campaign = ? AND counter >= ?'
+        params = [campaign, start]
+        if player is not None:
+            where += ' AND player = ?'
+            params.append(player)
+        with self.transaction():
+            self.execute(f'UPDATE savedata SET counter = counter + ? WHERE {where}', [delta] + params)
+            self.execute('DELETE FROM savedata WHERE campaign = ? AND counter <= 0'
+                         + (' AND player = ?' if player is not None else ''),
+                         [campaign] + ([player] if player is not None else []))
+
+    # Bundled campaign files, see app.seed_campaigns()
+
+    def seed_state(self, path):
+        row = self.execute('SELECT * FROM seeds WHERE path = ?', (path,)).fetchone()
+        if row is None:
+            return None
+        return {'stamp': row['stamp'], 'hash': row['hash'], 'campaign': row['campaign']}
+
+    def record_seed(self, path, entry):
+        self.execute('INSERT OR REPLACE INTO seeds (path, stamp, hash, campaign) VALUES (?, ?, ?, ?)',
+                     (path, entry['stamp'], entry['hash'], entry['campaign']))
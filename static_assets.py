@@ -0,0 +1,128 @@
+import os
+import time
+import gzip
+import threading
+import hashlib
+import mimetypes
+from email.utils import formatdate
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Files worth compressing; images are already compressed
+COMPRESSIBLE = ('.js', '.css', '.html', '.txt', '.json', '.svg')
+
+# Cache-Control of a fingerprinted URL, whose content can never change
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+# One static file held in memory with its validators and its gzip (and,
+# when the brotli module is installed, brotli) variants, all computed once
+# when the file is loaded.
+class Asset:
+    def __init__(self, path):
+        self.path = path
+        self.content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        if self.content_type.startswith('text/') or self.content_type.endswith('javascript'):
+            self.content_type += '; charset=utf-8'
+        self.load()
+
+    def load(self):
+        stat = os.stat(self.path)
+        with open(self.path, 'rb') as file:
+            self.body = file.read()
+        self.mtime = stat.st_mtime
+        self.stamp = (stat.st_mtime_ns, stat.st_size)
+        self.fingerprint = hashlib.sha1(self.body).hexdigest()[:12]
+        self.last_modified = formatdate(stat.st_mtime, usegmt=True)
+        self.variants = {}
+        if self.path.endswith(COMPRESSIBLE):
+            compressed = gzip.compress(self.body, 9, mtime=0)
+            if len(compressed) < len(self.body):
+                self.variants['gzip'] = compressed
+            if brotli is not None:
+                compressed = brotli.compress(self.body)
+                if len(compressed) < len(self.body):
+                    self.variants['br'] = compressed
+
+    def variant(self, accept_encodings):
+        # Smallest variant the client accepts, or the plain body
+        for encoding in ('br', 'gzip'):
+            if encoding in self.variants and encoding in accept_encodings:
+                return encoding, self.variants[encoding]
+        return None, self.body
+
+# The static directories of the app, loaded at startup. Pages link to
+# url(path), which carries the content hash of the file; a request with the
+# current hash may be cached forever, anything else is revalidated with the
+# ETag or Last-Modified date.
+class StaticAssets:
+    def __init__(self, root, dirs):
+        self.root = root
+        self.dirs = dirs
+        self.assets = {}
+        for d in dirs:
+            for parent, _, files in os.walk(os.path.join(root, d)):
+                for name in files:
+                    path = os.path.join(parent, name)
+                    key = os.path.relpath(path, root).replace(os.sep, '/')
+                    self.assets[key] = Asset(path)
+
+    def get(self, path):
+        return self.assets.get(path)
+
+    def url(self, path):
+        asset = self.assets.get(path)
+        if asset is None:
+            return '/' + path
+        return f'/{path}?v={asset.fingerprint}'
+
+# Documents served as they are, like the development guide: each is read
+# on its first request and then served from memory, and read again only
+# when its modification time or size changes. The file is looked at no more
+# than once every `check_interval` seconds.
+class Documents:
+    def __init__(self, root, check_interval=1.0):
+        self.root = root
+        self.check_interval = check_interval
+        self.docs = {}
+        self.checked = {}
+        self.lock = threading.Lock()
+
+    def get(self, name):
+        doc = self.docs.get(name)
+        now = time.monotonic()
+        if doc is not None and now - self.checked.get(name, 0) < self.check_interval:
+            return doc
+        path = os.path.join(self.root, name)
+        with self.lock:
+            try:
+                stat = os.stat(path)
+                if doc is None or doc.stamp != (stat.st_mtime_ns, stat.st_size):
+                    # A new Asset, so requests still holding the old one
+                    # never see a half-updated file
+                    doc = Asset(path)
+            except OSError:
+                doc = None
+            if doc is None:
+                self.docs.pop(name, None)
+            else:
+                self.docs[name] = doc
+            self.checked[name] = now
+        return doc
+
+def send_asset(app, request, asset):
+    encoding, body = asset.variant(request.accept_encodings)
+    response = app.response_class(body, content_type=asset.content_type)
+    response.set_etag(asset.fingerprint + ('-' + encoding if encoding else ''))
+    response.headers['Last-Modified'] = asset.last_modified
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    if asset.variants:
+        response.vary.add('Accept-Encoding')
+    if request.args.get('v') == asset.fingerprint:
+        response.headers['Cache-Control'] = IMMUTABLE
+    else:
+        response.headers['Cache-Control'] = 'public, no-cache'
+    return response.make_conditional(request)
@@ -0,0 +1,71 @@
+import os
+import queue
+import atexit
+import threading
+
+# Stores records on a background thread so requests do not wait for the
+# database. Records are queued and written in batches with `write_batch`
+# (a callable taking a list). The queue is bounded: when the writer falls
+# behind, submit() blocks until there is room again instead of letting
+# memory grow. Whatever is still queued is written at interpreter exit.
+class WriteBehind:
+    def __init__(self, write_batch, max_pending=1000, batch_size=100, name='write-behind'):
+        self.write_batch = write_batch
+        self.batch_size = batch_size
+        self.name = name
+        self.queue = queue.Queue(max_pending)
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pid = None
+        atexit.register(self.close)
+
+    def _start(self):
+        # Threads do not survive a fork, so every worker process of a
+        # preloaded app starts its own writer on first use
+        with self.lock:
+            if self.thread is not None and self.pid == os.getpid() and self.thread.is_alive():
+                return
+            if self.pid != os.getpid():
+                self.queue = queue.Queue(self.queue.maxsize)
+            self.pid = os.getpid()
+            self.thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self.thread.start()
+
+    def submit(self, item):
+        self._start()
+        self.queue.put(item)
+
+    def _run(self):
+        q = self.queue
+        while True:
+            batch = [q.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(q.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in batch
+            items = [item for item in batch if item is not None]
+            try:
+                if items:
+                    self.write_batch(items)
+            except Exception as e:
+                print(f"Error writing {len(items)} queued records: {e}")
+            finally:
+                for _ in batch:
+                    q.task_done()
+            if stop:
+                return
+
+    def flush(self):
+        # Wait until everything submitted so far is written
+        if self.thread is not None and self.pid == os.getpid():
+            self.queue.join()
+
+    def close(self):
+        with self.lock:
+            thread = self.thread if self.pid == os.getpid() else None
+            self.thread = None
+        if thread is not None and thread.is_alive():
+            self.queue.put(None)
+            thread.join()